@@ -11,7 +11,7 @@ export const AuthProvider = ({ children }) => {
   useEffect(() => {
     if (token) {
       axios
-        .get("http://127.0.0.1:8000/chats", {
+        .get("http://127.0.0.1:8000/chats?limit=1", {
           headers: { Authorization: `Bearer ${token}` },
         })
         .then(() => {
@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+# Load test for the chat API. Each virtual user signs up, logs in, holds a short
+# multi-turn /predict conversation that ends in a diagnosis, then reads /chats.
+#
+#   python benchmark.py --users 200 --concurrency 20 --latency-ms 50
+#   python benchmark.py --url http://localhost:8000 --users 50
+#
+# Without --url the app runs in-process with LLM_BACKEND=fake and a throwaway
+# database, so no Gemini credentials are needed (data.json and the model bundle
+# must still be present). Results are appended to --history and compared with
+# the previous run of the same shape to flag latency or throughput regressions.
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def conversation_script(symptom_master_list, user_index):
+    names = [s.lower().replace("_", " ").strip() for s in symptom_master_list if s.strip()]
+    picked = [names[(user_index * 3 + i) % len(names)] for i in range(3)]
+    return [
+        "hello",
+        f"I have {picked[0]} and {picked[1]}",
+        f"I have {picked[0]}, {picked[1]} and {picked[2]}, I am 34 years old female, previous health conditions: none",
+    ]
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    async def call(self, name, request):
+        started = time.perf_counter()
+        try:
+            response = await request
+            ok = response.status_code < 400
+            if ok and name == "predict":
+                # /predict reports pipeline failures in the body with a 200
+                ok = "error" not in response.json()
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.samples.setdefault(name, []).append(time.perf_counter() - started)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return response
+
+async def virtual_user(client, recorder, user_index, run_id, symptom_master_list):
+    username = f"bench_{run_id}_{user_index}"
+    await recorder.call("signup", client.post("/signup", json={"username": username, "email": f"{username}@bench.local", "password": "bench-password"}))
+    response = await recorder.call("login", client.post("/login", data={"username": username, "password": "bench-password"}))
+    if response is None or response.status_code != 200:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    conversation_id = None
+    for message in conversation_script(symptom_master_list, user_index):
+        response = await recorder.call("predict", client.post("/predict", json={"user_input": message, "conversation_id": conversation_id}, headers=headers))
+        if response is None or response.status_code != 200:
+            return
+        conversation_id = response.json().get("conversation_id")
+    await recorder.call("chats", client.get("/chats", params={"conversation_id": conversation_id}, headers=headers))
+
+async def run(client, args, symptom_master_list):
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+    async def guarded(user_index):
+        async with semaphore:
+            await virtual_user(client, recorder, user_index, run_id, symptom_master_list)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(guarded(i) for i in range(args.users)))
+    return recorder, time.perf_counter() - started
+
+def summarize(recorder, elapsed, args):
+    endpoints = {}
+    total = 0
+    for name, samples in recorder.samples.items():
+        samples = sorted(samples)
+        total += len(samples)
+        endpoints[name] = {
+            "requests": len(samples),
+            "errors": recorder.errors.get(name, 0),
+            "p50_ms": round(percentile(samples, 50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        }
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "label": args.label,
+        "mode": "http" if args.url else "in-process",
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "latency_ms": args.latency_ms,
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "requests_per_s": round(total / elapsed, 2) if elapsed else 0.0,
+        "endpoints": endpoints,
+    }
+
+def same_shape(a, b):
+    return all(a.get(k) == b.get(k) for k in ("mode", "users", "concurrency", "latency_ms"))
+
+def find_regressions(result, history_path, tolerance):
+    previous = None
+    if os.path.exists(history_path):
+        with open(history_path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                if same_shape(entry, result):
+                    previous = entry
+    if previous is None:
+        return None, []
+    regressions = []
+    for name, stats in result["endpoints"].items():
+        before = previous["endpoints"].get(name)
+        if before and before["p95_ms"] and stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name} p95 {before['p95_ms']}ms -> {stats['p95_ms']}ms")
+    if previous["requests_per_s"] and result["requests_per_s"] < previous["requests_per_s"] * (1 - tolerance):
+        regressions.append(f"throughput {previous['requests_per_s']} -> {result['requests_per_s']} req/s")
+    return previous, regressions
+
+def print_report(result, previous, regressions):
+    print(f"{result['requests']} requests in {result['elapsed_s']}s ({result['requests_per_s']} req/s), "
+          f"{result['users']} users at concurrency {result['concurrency']}, commit {result['commit']}")
+    print(f"{'endpoint':<10}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in result["endpoints"].items():
+        print(f"{name:<10}{stats['requests']:>10}{stats['errors']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    if previous is not None:
+        print(f"Compared with commit {previous['commit']} ({previous['timestamp']}):")
+        for line in regressions or ["no regressions"]:
+            print(f"  {line}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /predict and related endpoints")
+    parser.add_argument("--url", help="Base URL of a running server; omit to run the app in-process with the fake LLM")
+    parser.add_argument("--users", type=int, default=50, help="Number of virtual users")
+    parser.add_argument("--concurrency", type=int, default=10, help="Virtual users running at once")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Fake LLM latency per call (in-process only)")
+    parser.add_argument("--history", default="benchmark_history.jsonl", help="JSONL file of previous results")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown before a run counts as a regression")
+    parser.add_argument("--label", default="", help="Free-form note stored with the result")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when a regression is found")
+    args = parser.parse_args()
+
+    if args.url:
+        with open(os.getenv("DATA_FILE", "data.json"), "r") as f:
+            symptom_master_list = json.load(f)["symptom_master_list"]
+        client = httpx.AsyncClient(base_url=args.url, timeout=120)
+    else:
+        os.environ["LLM_BACKEND"] = "fake"
+        os.environ["FAKE_LLM_LATENCY_MS"] = str(args.latency_ms)
+        os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ayurvaid-bench-"), "bench.db")
+        import main as app_module
+        app_module.load_models()
+        symptom_master_list = app_module.get_config().symptom_master_list
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app_module.app), base_url="http://bench", timeout=120)
+
+    async def go():
+        async with client:
+            return await run(client, args, symptom_master_list)
+
+    recorder, elapsed = asyncio.run(go())
+    result = summarize(recorder, elapsed, args)
+    previous, regressions = find_regressions(result, args.history, args.tolerance)
+    print_report(result, previous, regressions)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# Offline scoring of symptom datasets with the disease model, without the HTTP
+# API, an LLM or a login. Records are streamed in chunks of --chunk-size, each
+# chunk is vectorized and scored in a worker process, and results are written
+# in input order, so memory stays bounded by the chunks in flight.
+#
+#   python bulk_score.py intake.csv scored.jsonl --top-k 3
+#   python bulk_score.py records.jsonl scored.csv --workers 8 --chunk-size 20000
+#
+# CSV input needs a symptoms column holding a comma-separated list or a JSON
+# array; JSONL records need a "symptoms" list or string. An id column/key is
+# copied to the output when present, otherwise the record number is used. The
+# output format follows the output file extension (.csv or .jsonl).
+
+# main opens its database on import; scoring never touches it
+os.environ.setdefault("DB_PATH", ":memory:")
+
+import main
+
+_config = None
+_model_name = None
+
+# model_name is resolved once in the parent, so every worker scores with the
+# same version even if the registry's active version changes mid-run
+def init_worker(model_name):
+    global _config, _model_name
+    logging.getLogger().setLevel(logging.WARNING)
+    _config = main.get_config()
+    _model_name = model_name
+    main.model_registry.refresh()
+    main.model_registry.get(model_name)
+
+def score_chunk(chunk, top_k):
+    symptom_lists = [main.parseSymptomList(symptoms) for _, symptoms in chunk]
+    rankings, matched = main.predict_diseases_batch_top_k(symptom_lists, _config.symptom_index, top_k, _model_name)
+    results = []
+    for (record_id, _), ranked, count in zip(chunk, rankings, matched):
+        if not ranked:
+            results.append({"id": record_id, "prediction": "No disease predicted (no symptoms matched)", "matched": 0, "top_k": []})
+            continue
+        results.append({"id": record_id, "prediction": ranked[0][0], "matched": int(count), "top_k": [list(pair) for pair in ranked]})
+    return results
+
+def read_records(path, id_field, symptoms_field):
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for number, row in enumerate(csv.DictReader(f)):
+                yield row.get(id_field) or number, row.get(symptoms_field) or ""
+        else:
+            for number, line in enumerate(f):
+                if line.strip():
+                    record = json.loads(line)
+                    yield record.get(id_field, number), record.get(symptoms_field) or []
+
+class ResultWriter:
+    def __init__(self, path, top_k):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._top_k = top_k
+        self._csv = None
+        if path.endswith(".csv"):
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(["id", "prediction", "matched"] + (["top_k"] if top_k > 1 else []))
+
+    def write(self, results):
+        for result in results:
+            if self._csv is None:
+                if self._top_k <= 1:
+                    result = {key: value for key, value in result.items() if key != "top_k"}
+                self._file.write(json.dumps(result) + "\n")
+            else:
+                row = [result["id"], result["prediction"], result["matched"]]
+                if self._top_k > 1:
+                    row.append(";".join(f"{disease}:{probability}" for disease, probability in result["top_k"]))
+                self._csv.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+def chunks(records, size):
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Score a CSV/JSONL symptom dataset with the disease model")
+    parser.add_argument("input", help="Input .csv or .jsonl file")
+    parser.add_argument("output", help="Output .csv or .jsonl file")
+    parser.add_argument("--top-k", type=int, default=1, help="Ranked diseases with probabilities per record")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Records per worker task")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--model", default=None, help="Model version from the registry (default: active)")
+    parser.add_argument("--id-field", default="id", help="Column/key copied to the output as the record id")
+    parser.add_argument("--symptoms-field", default="symptoms", help="Column/key holding the symptoms")
+    args = parser.parse_args()
+
+    main.model_registry.refresh()
+    model_name = args.model or main.model_registry.status()["active"]
+    if not main.model_registry.has(model_name):
+        parser.error(f"Unknown model version '{model_name}'")
+
+    writer = ResultWriter(args.output, args.top_k)
+    records = read_records(args.input, args.id_field, args.symptoms_field)
+    started = time.perf_counter()
+    scored = 0
+    # At most two chunks per worker are queued, so reading never runs far ahead
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(model_name,)) as pool:
+        pending = deque()
+        for chunk in chunks(records, args.chunk_size):
+            pending.append(pool.submit(score_chunk, chunk, args.top_k))
+            while len(pending) >= args.workers * 2 or (pending and pending[0].done()):
+                results = pending.popleft().result()
+                writer.write(results)
+                scored += len(results)
+            elapsed = time.perf_counter() - started
+            print(f"\r{scored} records, {scored / elapsed:.0f} records/s", end="", file=sys.stderr)
+        while pending:
+            results = pending.popleft().result()
+            writer.write(results)
+            scored += len(results)
+    writer.close()
+    elapsed = time.perf_counter() - started
+    print(f"\rScored {scored} records in {elapsed:.2f}s ({scored / elapsed if elapsed else 0:.0f} records/s)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Optional
+
+# Deterministic stand-in for Gemini chat sessions, used with LLM_BACKEND=fake so
+# /predict can be exercised and benchmarked without credentials. Replies depend
+# only on the system prompt (which pipeline stage is asking) and the prompt text.
+# FAKE_LLM_LATENCY_MS adds a fixed delay per call; FAKE_LLM_REPLIES may point at
+# a JSON file of {"stage": "reply"} overrides, using the stage names from
+# stage_for_prompt().
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+FAKE_LLM_REPLIES = os.getenv("FAKE_LLM_REPLIES")
+
+GREETINGS = {"hi", "hello", "hey", "thanks", "thank", "bye", "namaste"}
+GENDERS = {"male": "male", "man": "male", "boy": "male", "female": "female", "woman": "female", "girl": "female"}
+
+FINAL_RESPONSE_TEMPLATE = (
+    "Disease Name: {disease}\n\n"
+    "Ayurvedic Disease Name: {rog}\n\n"
+    "Symptoms:\n\n{symptoms}\n\n"
+    "In Ayurvedic terms, this condition is understood as an imbalance of the doshas. "
+    "The following Ayurvedic medications are suggested to manage the symptoms: {medicines}. "
+    "These are not intended to replace conventional medical treatment. "
+    "Please consult a qualified doctor before making health decisions.\n"
+)
+
+def _load_overrides() -> dict:
+    if not FAKE_LLM_REPLIES:
+        return {}
+    with open(FAKE_LLM_REPLIES, "r") as f:
+        return json.load(f)
+
+_overrides = _load_overrides()
+
+def stage_for_prompt(system_prompt: str, config) -> str:
+    stages = {
+        config.intent_prompt: "intent",
+        config.conversational_prompt: "conversational",
+        config.system_prompt: "extraction",
+        config.ayurvedic_system_prompt: "ayurvedic",
+        config.final_response_system_prompt: "final",
+        config.adjustment_prompt: "adjustment",
+        config.merged_prompt: "merged",
+    }
+    return stages.get(system_prompt, "conversational")
+
+def _field(prompt: str, name: str) -> str:
+    match = re.search(rf"{name}: ([^\n]*)", prompt)
+    return match.group(1).strip() if match else ""
+
+def fake_reply(stage: str, prompt: str, config) -> str:
+    if stage in _overrides:
+        return _overrides[stage]
+    # With conversation context the prompt ends with "User: <input>"; only the
+    # input itself decides the intent and the extracted fields
+    latest = re.split(r"^User: ", prompt, flags=re.M)[-1] if prompt else ""
+    words = re.findall(r"[a-z0-9]+", latest.lower())
+    if stage == "intent":
+        return "general" if words and all(w in GREETINGS for w in words[:2]) else "symptom"
+    if stage == "extraction":
+        text = " ".join(words)
+        names = (" ".join(re.findall(r"[a-z0-9]+", s.lower())) for s in config.symptom_master_list)
+        symptoms = [name for name in names if name and f" {name} " in f" {text} "]
+        age = next((w for w in words if w.isdigit()), None)
+        gender = next((GENDERS[w] for w in words if w in GENDERS), None)
+        return json.dumps({"symptoms": symptoms, "age": age, "gender": gender, "previous_conditions": []})
+    if stage == "merged":
+        extracted = json.loads(fake_reply("extraction", prompt, config))
+        return json.dumps({"intent": fake_reply("intent", prompt, config), **extracted})
+    if stage == "adjustment":
+        return json.dumps({"disease_adjustment": "None", "medicine_adjustment": "None"})
+    if stage == "ayurvedic":
+        disease = _field(prompt, "Diseases")
+        return config.ayurvedic_hash.get(disease, "Unknown")
+    if stage == "final":
+        symptoms = "\n".join(f"{s.strip()}: reported by the user." for s in _field(prompt, "Symptoms").split(",") if s.strip())
+        return FINAL_RESPONSE_TEMPLATE.format(
+            disease=_field(prompt, "Disease Name"),
+            rog=_field(prompt, "Aurvedic Disease Name"),
+            symptoms=symptoms,
+            medicines=_field(prompt, "Aurvedic Medications List")
+        )
+    return "Hello! I can help you understand your symptoms. How are you feeling today?"
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeChatSession:
+    def __init__(self, system_prompt: str, config, history: Optional[list] = None, latency_ms: float = FAKE_LLM_LATENCY_MS):
+        self.stage = stage_for_prompt(system_prompt, config)
+        self.history = list(history or [])
+        self._config = config
+        self._latency = latency_ms / 1000
+
+    def _reply(self, prompt: str) -> FakeResponse:
+        text = fake_reply(self.stage, prompt, self._config)
+        self.history.append({"role": "user", "parts": [prompt]})
+        self.history.append({"role": "model", "parts": [text]})
+        return FakeResponse(text)
+
+    def send_message(self, prompt: str) -> FakeResponse:
+        if self._latency:
+            time.sleep(self._latency)
+        return self._reply(prompt)
+
+    async def send_message_async(self, prompt: str, stream: bool = False):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        response = self._reply(prompt)
+        return FakeStream(response.text) if stream else response
+
+class FakeStream:
+    def __init__(self, text: str, chunk_size: int = 24):
+        self.text = text
+        self._chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(0)
+            yield FakeResponse(chunk)
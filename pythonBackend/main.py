@@ -1,15 +1,34 @@
-from fastapi import FastAPI, Request, HTTPException, Depends, status
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Query
 import os
+import re
+import math
+import io
+import hashlib
+import base64
+import threading
+import zlib
+import time
 import joblib
 import json
+import numpy as np
 import pandas as pd
 import sqlite3
+import queue
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional, Dict, Mapping, Tuple
+from dataclasses import dataclass
+from types import MappingProxyType
 import google.generativeai as genai
 import jwt
 from passlib.context import CryptContext
@@ -41,54 +60,641 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt is deliberately slow, so hashing and verification get their own small
+# pool instead of tying up the request and database threads during login storms
+AUTH_WORKERS = int(os.getenv("AUTH_WORKERS", "2"))
+auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+
+# Authenticated users are cached by token subject for a short time
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# Database configuration
+DB_PATH = os.getenv("DB_PATH", "ayurvaid.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Extra pooled connections beyond the db_executor workers, for sync endpoints
+# (/chats/export, /conversations/archived) and the maintenance thread
+DB_POOL_RESERVE = int(os.getenv("DB_POOL_RESERVE", "2"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# Prompt and dataset configuration
+DATA_FILE = os.getenv("DATA_FILE", "data.json")
+
+# LLM backend: "gemini", or "fake" for the offline stand-in in fake_llm.py
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+
+# Model configuration
+MODEL_PATH = os.getenv("MODEL_PATH", "disease_lr_model_with_encoder.joblib")
+MODEL_REGISTRY_FILE = os.getenv("MODEL_REGISTRY_FILE", "models.json")
+MODEL_CHECK_INTERVAL = float(os.getenv("MODEL_CHECK_INTERVAL", "5"))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+PREDICTION_TOP_K = int(os.getenv("PREDICTION_TOP_K", "3"))
+
+# Per-stage timeouts (seconds) for the LLM stages of a diagnosis
+LLM_STAGE_TIMEOUT = float(os.getenv("LLM_STAGE_TIMEOUT", "20"))
+FINAL_RESPONSE_TIMEOUT = float(os.getenv("FINAL_RESPONSE_TIMEOUT", "60"))
+
+# Cache for deterministic LLM stages (adjustment, Ayurvedic classification)
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Local intent classifier: answers in-process when its confidence reaches the
+# threshold (set above 1 to always ask Gemini) and retrains from stored labels
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", "0.9"))
+INTENT_RETRAIN_EVERY = int(os.getenv("INTENT_RETRAIN_EVERY", "200"))
+INTENT_TRAINING_LIMIT = int(os.getenv("INTENT_TRAINING_LIMIT", "5000"))
+
+# Gemini chat session limits
+SESSION_MAX_CONVERSATIONS = int(os.getenv("SESSION_MAX_CONVERSATIONS", "1000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_REBUILD_MESSAGES = int(os.getenv("SESSION_REBUILD_MESSAGES", "10"))
+
+# Prompt context budgets, in estimated tokens (about 4 characters each)
+CONTEXT_WINDOW_MESSAGES = int(os.getenv("CONTEXT_WINDOW_MESSAGES", "6"))
+CONTEXT_REPLY_CHARS = int(os.getenv("CONTEXT_REPLY_CHARS", "400"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "200"))
+CONTEXT_BUDGETS = {
+    "intent": int(os.getenv("CONTEXT_BUDGET_INTENT", "250")),
+    "extraction": int(os.getenv("CONTEXT_BUDGET_EXTRACTION", "600")),
+    "conversational": int(os.getenv("CONTEXT_BUDGET_CONVERSATIONAL", "800"))
+}
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "2000"))
+
+# Minimum trigram similarity (0-1) for a fuzzy symptom match
+SYMPTOM_MATCH_THRESHOLD = float(os.getenv("SYMPTOM_MATCH_THRESHOLD", "0.75"))
+
+# "merged" asks for the intent and the extracted fields in one structured call,
+# falling back to the separate intent and extraction calls on invalid output
+INTENT_EXTRACTION_MODE = os.getenv("INTENT_EXTRACTION_MODE", "separate").lower()
+
+# Background maintenance: pending-chat expiry, archival of old conversations
+# (0 days disables it) and incremental vacuum, every MAINTENANCE_INTERVAL seconds
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+PENDING_CHAT_TTL_HOURS = float(os.getenv("PENDING_CHAT_TTL_HOURS", str(7 * 24)))
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000"))
+# Switching an existing database to incremental auto_vacuum needs a full VACUUM
+# that locks the file; it only runs when this is set, e.g. during a maintenance window
+MAINTENANCE_CONVERT_AUTO_VACUUM = os.getenv("MAINTENANCE_CONVERT_AUTO_VACUUM", "false").lower() in ("1", "true", "yes")
+
+# Pipeline metrics; the Server-Timing header on /predict is off by default
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "false").lower() in ("1", "true", "yes")
+
+def _contentChars(content) -> int:
+    parts = content.get("parts", []) if isinstance(content, dict) else getattr(content, "parts", None) or []
+    return sum(len(part if isinstance(part, str) else getattr(part, "text", "") or "") for part in parts)
+
 # Global chat session storage
-chat_sessions: Dict[str, Dict[str, Dict[str, genai.ChatSession]]] = {}
+# One entry per (user_id, conversation_id) holding a ChatSession per system prompt.
+# Conversations idle for longer than SESSION_IDLE_TTL are dropped, and the least
+# recently used ones go first when the entry or estimated history-size cap is hit.
+# An evicted conversation is rebuilt from the chats table on its next turn.
+# Each entry also records the conversation's message count when it was last in
+# sync with the database. When several workers serve the same conversation, a
+# count that no longer matches means another worker has handled turns since,
+# so the sessions are dropped and rebuilt from the shared history.
+class SessionManager:
+    def __init__(self, max_conversations: int, idle_ttl: float, max_bytes: int, memory_check_interval: float = 10.0):
+        self._max_conversations = max_conversations
+        self._idle_ttl = idle_ttl
+        self._max_bytes = max_bytes
+        self._memory_check_interval = memory_check_interval
+        self._entries: "OrderedDict[Tuple[str, str], Dict[str, genai.ChatSession]]" = OrderedDict()
+        self._last_used: Dict[Tuple[str, str], float] = {}
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._last_memory_check = 0.0
+        self._estimated_bytes = 0
+        self._created = 0
+        self._rebuilt = 0
+        self._evictions = {"idle": 0, "capacity": 0, "memory": 0}
+
+    @staticmethod
+    def _session_bytes(session) -> int:
+        return sum(_contentChars(content) for content in getattr(session, "history", None) or [])
+
+    def _entry_bytes(self, key) -> int:
+        return sum(self._session_bytes(session) for session in self._entries[key].values())
+
+    def _evict(self, reason: str):
+        key, _ = self._entries.popitem(last=False)
+        del self._last_used[key]
+        self._versions.pop(key, None)
+        self._evictions[reason] += 1
+
+    def _sweep(self, now: float):
+        while self._entries:
+            oldest = next(iter(self._entries))
+            if now - self._last_used[oldest] <= self._idle_ttl:
+                break
+            self._evict("idle")
+        while len(self._entries) > self._max_conversations:
+            self._evict("capacity")
+        if now - self._last_memory_check >= self._memory_check_interval:
+            self._last_memory_check = now
+            sizes = {key: self._entry_bytes(key) for key in self._entries}
+            total = sum(sizes.values())
+            while total > self._max_bytes and len(self._entries) > 1:
+                total -= sizes[next(iter(self._entries))]
+                self._evict("memory")
+            self._estimated_bytes = total
+
+    def has(self, user_id, conversation_id) -> bool:
+        with self._lock:
+            return (user_id, conversation_id) in self._entries
+
+    def version(self, user_id, conversation_id) -> Optional[int]:
+        with self._lock:
+            return self._versions.get((user_id, conversation_id))
+
+    def set_version(self, user_id, conversation_id, message_count: int):
+        key = (user_id, conversation_id)
+        with self._lock:
+            if key in self._entries:
+                self._versions[key] = message_count
+
+    def discard(self, user_id, conversation_id):
+        key = (user_id, conversation_id)
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                del self._last_used[key]
+            self._versions.pop(key, None)
+
+    def get(self, user_id, conversation_id, systemPrompt: str, factory: Callable[[], genai.ChatSession]):
+        key = (user_id, conversation_id)
+        now = time.monotonic()
+        with self._lock:
+            sessions = self._entries.setdefault(key, {})
+            self._entries.move_to_end(key)
+            self._last_used[key] = now
+            self._sweep(now)
+            session = sessions.get(systemPrompt)
+        if session is None:
+            # Build outside the lock; if two requests race, the first one stored wins
+            new_session = factory()
+            with self._lock:
+                sessions = self._entries.setdefault(key, {})
+                self._last_used.setdefault(key, now)
+                session = sessions.setdefault(systemPrompt, new_session)
+                if session is new_session:
+                    self._created += 1
+                    if getattr(new_session, "history", None):
+                        self._rebuilt += 1
+        return session
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "conversations": len(self._entries),
+                "sessions": sum(len(sessions) for sessions in self._entries.values()),
+                "estimated_history_bytes": self._estimated_bytes,
+                "created_total": self._created,
+                "rebuilt_total": self._rebuilt,
+                "evictions_total": dict(self._evictions)
+            }
+
+chat_sessions = SessionManager(SESSION_MAX_CONVERSATIONS, SESSION_IDLE_TTL, SESSION_MAX_BYTES)
+
+# SQLite connection pool
+# Connections are opened lazily up to DB_POOL_SIZE and reused, so sqlite3's
+# per-connection statement cache carries prepared statements across requests.
+# WAL lets readers proceed while a writer commits.
+class ConnectionPool:
+    def __init__(self, path: str, size: int, timeout: float):
+        self._path = path
+        self._size = size
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._wait_seconds = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self._path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self._size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+        started = time.monotonic()
+        with self._lock:
+            self._waits += 1
+        try:
+            return self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            logger.warning(f"Database pool exhausted: {self._size} connections busy for {self._timeout}s")
+            raise sqlite3.OperationalError("Database connection pool exhausted")
+        finally:
+            with self._lock:
+                self._wait_seconds += time.monotonic() - started
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                self._in_use -= 1
+            self._idle.put(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self._size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._created - self._in_use,
+                "acquired_total": self._acquired,
+                "waits_total": self._waits,
+                "timeouts_total": self._timeouts,
+                "wait_seconds_total": round(self._wait_seconds, 6)
+            }
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE + DB_POOL_RESERVE, DB_POOL_TIMEOUT)
+
+# Blocking sqlite3 work from async endpoints runs here instead of on the event
+# loop. The pool has DB_POOL_RESERVE connections more than there are workers.
+# Sync endpoints and the maintenance thread (which holds a connection for a
+# whole run) draw from it too, so under heavy load a worker can still wait, up
+# to DB_POOL_TIMEOUT.
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+# Pipeline metrics
+# Latency histograms and error counts per /predict stage, LLM call counts and
+# the component stats, rendered in the Prometheus text format by /metrics. A
+# TurnTimer follows one turn through a context variable, so the Gemini helpers
+# can count calls without it being passed down.
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LLM_CALL_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, name: str, labels: str = "") -> List[str]:
+        prefix = f"{labels}," if labels else ""
+        lines = [f'{name}_bucket{{{prefix}le="{bound}"}} {count}' for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {round(self.sum, 6)}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class PipelineMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Histogram] = {}
+        self._stage_errors: Dict[str, int] = {}
+        self._llm_calls_per_turn = Histogram(LLM_CALL_BUCKETS)
+        self._counters = {"turns_total": 0, "llm_calls_total": 0, "llm_errors_total": 0, "merged_fallbacks_total": 0, "rog_local_total": 0}
+
+    def count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def observe_stage(self, stage: str, seconds: float, failed: bool):
+        with self._lock:
+            self._stages.setdefault(stage, Histogram(STAGE_BUCKETS)).observe(seconds)
+            self._stage_errors[stage] = self._stage_errors.get(stage, 0) + int(failed)
+
+    def finish_turn(self, timer: "TurnTimer"):
+        with self._lock:
+            self._counters["turns_total"] += 1
+            self._llm_calls_per_turn.observe(timer.llm_calls)
+
+    def render(self, gauges: Dict[str, dict]) -> str:
+        lines = []
+        with self._lock:
+            lines += ["# HELP ayurvaid_stage_duration_seconds Time spent in each /predict stage", "# TYPE ayurvaid_stage_duration_seconds histogram"]
+            for stage, histogram in sorted(self._stages.items()):
+                lines += histogram.render("ayurvaid_stage_duration_seconds", f'stage="{stage}"')
+            lines += ["# HELP ayurvaid_stage_errors_total Stage runs that raised, timed out or got a Gemini error", "# TYPE ayurvaid_stage_errors_total counter"]
+            lines += [f'ayurvaid_stage_errors_total{{stage="{stage}"}} {count}' for stage, count in sorted(self._stage_errors.items())]
+            lines += ["# HELP ayurvaid_llm_calls_per_turn Gemini calls made by one /predict turn", "# TYPE ayurvaid_llm_calls_per_turn histogram"]
+            lines += self._llm_calls_per_turn.render("ayurvaid_llm_calls_per_turn")
+            for counter, value in self._counters.items():
+                lines += [f"# TYPE ayurvaid_{counter} counter", f"ayurvaid_{counter} {value}"]
+        for component, stats in gauges.items():
+            for key, value in stats.items():
+                values = value.items() if isinstance(value, dict) else [("", value)]
+                for sub, v in values:
+                    if isinstance(v, (int, float)):
+                        name = f"ayurvaid_{component}_{key}" + (f"_{sub}" if sub else "")
+                        lines += [f"# TYPE {name} gauge", f"{name} {float(v)}"]
+        return "\n".join(lines) + "\n"
+
+pipeline_metrics = PipelineMetrics()
+
+class TurnTimer:
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self.llm_calls = 0
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        state = {"failed": False}
+        token = current_span.set(state)
+        failed = True
+        try:
+            yield
+            failed = state["failed"]
+        finally:
+            current_span.reset(token)
+            elapsed = time.perf_counter() - started
+            self.durations[stage] = self.durations.get(stage, 0.0) + elapsed
+            pipeline_metrics.observe_stage(stage, elapsed, failed)
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.durations.items())
+
+current_turn: contextvars.ContextVar[Optional[TurnTimer]] = contextvars.ContextVar("current_turn", default=None)
+# The innermost open span; per task, so stages running side by side don't share it
+current_span: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("current_span", default=None)
+
+def countLlmCall():
+    pipeline_metrics.count("llm_calls_total")
+    timer = current_turn.get()
+    if timer is not None:
+        timer.llm_calls += 1
+
+# The Gemini helpers return GEMINI_ERROR_RESPONSE instead of raising, so the
+# stage they ran in is marked failed here
+def countLlmError():
+    pipeline_metrics.count("llm_errors_total")
+    span = current_span.get()
+    if span is not None:
+        span["failed"] = True
 
 # SQLite database setup
-def init_db():
-    conn = sqlite3.connect("ayurvaid.db")
-    cursor = conn.cursor()
+# Conversation name: the first user message, cut to 30 characters
+def _conversationNameSql(message: str) -> str:
+    return (
+        f"trim(CASE WHEN length({message}) > 30 THEN substr({message}, 1, 30) || '...' ELSE {message} END, "
+        "' ' || char(9) || char(10) || char(13))"
+    )
+
+# Full-text index over chats.message (external content, so the text is not
+# stored twice), kept in sync by triggers. Every row also carries an owner
+# token ("u<user_id>") that search always includes in its MATCH expression, so
+# a query only walks the caller's rows instead of every user's. Falls back to
+# LIKE scans when the SQLite build lacks FTS5.
+chat_search_enabled = False
+
+def _ftsOwner(user_id) -> str:
+    return f"u{user_id}"
+
+def _init_chat_search(cursor):
+    global chat_search_enabled
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chats_fts'")
+    existing = cursor.fetchone()
+    if existing is not None and "owner" not in existing[0]:
+        # Index from before the owner column; recreate it and its triggers
+        for trigger in ("chats_fts_insert", "chats_fts_delete", "chats_fts_update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE chats_fts")
+        existing = None
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            hashed_password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE VIEW IF NOT EXISTS chats_fts_source AS
+        SELECT id, message, 'u' || user_id AS owner FROM chats
+    """)
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(
+                message,
+                owner,
+                content = 'chats_fts_source',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 unavailable, chat search will scan with LIKE: {str(e)}")
+        return
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS chats_fts_insert AFTER INSERT ON chats BEGIN
+            INSERT INTO chats_fts (rowid, message, owner) VALUES (NEW.id, NEW.message, 'u' || NEW.user_id);
+        END
     """)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            conversation_id TEXT NOT NULL,
-            sender TEXT NOT NULL,
-            message TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, conversation_id, timestamp)
-        )
+        CREATE TRIGGER IF NOT EXISTS chats_fts_delete AFTER DELETE ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message, owner) VALUES ('delete', OLD.id, OLD.message, 'u' || OLD.user_id);
+        END
     """)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS pending_chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            conversation_id TEXT NOT NULL,
-            symptoms TEXT,
-            age TEXT,
-            gender TEXT,
-            previous_conditions TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, conversation_id)
-        )
+        CREATE TRIGGER IF NOT EXISTS chats_fts_update AFTER UPDATE OF message, user_id ON chats BEGIN
+            INSERT INTO chats_fts (chats_fts, rowid, message, owner) VALUES ('delete', OLD.id, OLD.message, 'u' || OLD.user_id);
+            INSERT INTO chats_fts (rowid, message, owner) VALUES (NEW.id, NEW.message, 'u' || NEW.user_id);
+        END
     """)
-    conn.commit()
-    conn.close()
+    if existing is None:
+        cursor.execute("INSERT INTO chats_fts (chats_fts) VALUES ('rebuild')")
+    chat_search_enabled = True
+
+def init_db():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        # A new, empty database starts in incremental auto_vacuum (the VACUUM is
+        # instant); existing files are converted by the maintenance thread only
+        # when MAINTENANCE_CONVERT_AUTO_VACUUM is set
+        if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("VACUUM")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                hashed_password TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                conversation_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                message TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                UNIQUE(user_id, conversation_id, timestamp)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pending_chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                conversation_id TEXT NOT NULL,
+                symptoms TEXT,
+                age TEXT,
+                gender TEXT,
+                previous_conditions TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                UNIQUE(user_id, conversation_id)
+            )
+        """)
+        # Denormalized per-conversation summary for the sidebar, kept current by a
+        # trigger on chats. Lookups by (user_id, conversation_id, timestamp) on chats
+        # are already served by the index behind its UNIQUE constraint.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'")
+        backfill_conversations = cursor.fetchone() is None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id INTEGER NOT NULL,
+                conversation_id TEXT NOT NULL,
+                name TEXT,
+                latest_timestamp TIMESTAMP,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, conversation_id),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_user_latest ON conversations (user_id, latest_timestamp DESC)")
+        if backfill_conversations:
+            cursor.execute("""
+                INSERT OR IGNORE INTO conversations (user_id, conversation_id, latest_timestamp, message_count)
+                SELECT user_id, conversation_id, MAX(timestamp), COUNT(*) FROM chats GROUP BY user_id, conversation_id
+            """)
+            cursor.execute(f"""
+                UPDATE conversations SET name = (
+                    SELECT {_conversationNameSql("c.message")} FROM chats c
+                    WHERE c.user_id = conversations.user_id AND c.conversation_id = conversations.conversation_id AND c.sender = 'user'
+                    ORDER BY c.timestamp ASC LIMIT 1
+                )
+            """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS chats_conversations_insert AFTER INSERT ON chats
+            BEGIN
+                INSERT INTO conversations (user_id, conversation_id, name, latest_timestamp, message_count)
+                VALUES (
+                    NEW.user_id,
+                    NEW.conversation_id,
+                    CASE WHEN NEW.sender = 'user' THEN {_conversationNameSql("NEW.message")} END,
+                    NEW.timestamp,
+                    1
+                )
+                ON CONFLICT (user_id, conversation_id) DO UPDATE SET
+                    latest_timestamp = MAX(latest_timestamp, excluded.latest_timestamp),
+                    message_count = message_count + 1,
+                    name = COALESCE(name, excluded.name);
+            END
+        """)
+        _init_chat_search(cursor)
+        # Keyset pagination over a user's whole history walks (user_id, timestamp, id)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chats_user_timestamp ON chats (user_id, timestamp)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id INTEGER NOT NULL,
+                conversation_id TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                last_chat_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, conversation_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS intent_labels (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL,
+                intent TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Conversations moved out of chats by the maintenance thread; payload is
+        # the zlib-compressed JSON list of their messages
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archived_conversations (
+                user_id INTEGER NOT NULL,
+                conversation_id TEXT NOT NULL,
+                name TEXT,
+                latest_timestamp TIMESTAMP,
+                message_count INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, conversation_id)
+            )
+        """)
+        # One row per background job; every uvicorn worker starts the maintenance
+        # thread, and only the holder of an unexpired lease does the work
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS maintenance_lease (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS rog_mappings (
+                disease TEXT PRIMARY KEY,
+                rog TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
 
 init_db()
 
@@ -106,6 +712,10 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
+class BatchInputData(BaseModel):
+    records: List[List[str]]
+    model_name: Optional[str] = None
+
 class ChatMessage(BaseModel):
     sender: str
     message: str
@@ -113,26 +723,104 @@ class ChatMessage(BaseModel):
     conversation_id: str
 
 # Utility functions
-def loadDataFromJson():
-    try:
-        with open("data.json", "r") as f:
-            loaded_data = json.load(f)
-        return (
-            loaded_data["systemPrompt"],
-            loaded_data["symptom_master_list"],
-            loaded_data["ayurvedicHash"],
-            loaded_data["ayurvedicSystemPrompt"],
-            loaded_data.get("aryuvedicMedicineData", {}),
-            loaded_data["finalResponseSystemPrompt"],
-            loaded_data.get("conversationalPrompt", "Respond conversationally..."),
-            loaded_data.get("intentPrompt", "Classify the input..."),
-            loaded_data.get("adjustmentPrompt", "Given a disease...")
-        )
-    except Exception as e:
-        logger.error(f"Failed to load data.json: {str(e)}")
-        raise ValueError(f"Failed to load data.json: {str(e)}")
+# Configuration
+# data.json is parsed and validated once, then shared read-only across requests.
+# get_config() re-stats the file on each call and reparses only when its mtime
+# changes; a broken edit is logged and the last good config keeps serving.
+@dataclass(frozen=True)
+class AppConfig:
+    system_prompt: str
+    symptom_master_list: Tuple[str, ...]
+    ayurvedic_hash: Mapping[str, str]
+    ayurvedic_system_prompt: str
+    ayurvedic_medicine_data: Mapping[str, list]
+    final_response_system_prompt: str
+    conversational_prompt: str
+    intent_prompt: str
+    adjustment_prompt: str
+    merged_prompt: str
+    symptom_synonyms: Mapping[str, str]
+    symptom_index: "SymptomIndex"
+    rog_index: "RogIndex"
+    mtime: float
+
+def _requireType(loaded_data: dict, key: str, expected_type, default=None):
+    value = loaded_data.get(key, default)
+    if value is None:
+        raise ValueError(f"Missing required key '{key}'")
+    if not isinstance(value, expected_type):
+        raise ValueError(f"Key '{key}' must be of type {expected_type.__name__}")
+    return value
+
+MERGED_PROMPT_SUFFIX = (
+    "Answer with a single JSON object with the keys intent, symptoms, age, gender and previous_conditions. "
+    "intent is \"general\" for greetings and small talk and \"symptom\" for anything about health or symptoms; "
+    "for general messages leave the list fields empty and age and gender null."
+)
+
+def parseConfig(loaded_data: dict, mtime: float) -> AppConfig:
+    symptom_master_list = _requireType(loaded_data, "symptom_master_list", list)
+    if not symptom_master_list or not all(isinstance(s, str) for s in symptom_master_list):
+        raise ValueError("symptom_master_list must be a non-empty list of strings")
+    symptom_synonyms = _requireType(loaded_data, "symptomSynonyms", dict, {})
+    ayurvedic_hash = _requireType(loaded_data, "ayurvedicHash", dict)
+    ayurvedic_medicine_data = _requireType(loaded_data, "aryuvedicMedicineData", dict, {})
+    system_prompt = _requireType(loaded_data, "systemPrompt", str)
+    intent_prompt = _requireType(loaded_data, "intentPrompt", str, "Classify the input...")
+    return AppConfig(
+        system_prompt=system_prompt,
+        symptom_master_list=tuple(symptom_master_list),
+        ayurvedic_hash=MappingProxyType(ayurvedic_hash),
+        ayurvedic_system_prompt=_requireType(loaded_data, "ayurvedicSystemPrompt", str),
+        ayurvedic_medicine_data=MappingProxyType(ayurvedic_medicine_data),
+        final_response_system_prompt=_requireType(loaded_data, "finalResponseSystemPrompt", str),
+        conversational_prompt=_requireType(loaded_data, "conversationalPrompt", str, "Respond conversationally..."),
+        intent_prompt=intent_prompt,
+        adjustment_prompt=_requireType(loaded_data, "adjustmentPrompt", str, "Given a disease..."),
+        merged_prompt=_requireType(loaded_data, "mergedPrompt", str, f"{intent_prompt}\n\n{system_prompt}\n\n{MERGED_PROMPT_SUFFIX}"),
+        symptom_synonyms=MappingProxyType(symptom_synonyms),
+        symptom_index=SymptomIndex(symptom_master_list, symptom_synonyms),
+        rog_index=RogIndex(ayurvedic_hash, ayurvedic_medicine_data),
+        mtime=mtime
+    )
+
+_config: Optional[AppConfig] = None
+_config_failed_mtime: Optional[float] = None
+_config_lock = threading.Lock()
+
+def get_config() -> AppConfig:
+    global _config, _config_failed_mtime
+    try:
+        mtime = os.path.getmtime(DATA_FILE)
+    except OSError as e:
+        if _config is not None:
+            return _config
+        logger.error(f"Failed to load {DATA_FILE}: {str(e)}")
+        raise ValueError(f"Failed to load {DATA_FILE}: {str(e)}")
+    config = _config
+    if config is not None and mtime in (config.mtime, _config_failed_mtime):
+        return config
+    with _config_lock:
+        if _config is not None and mtime in (_config.mtime, _config_failed_mtime):
+            return _config
+        try:
+            with open(DATA_FILE, "r") as f:
+                loaded_data = json.load(f)
+            _config = parseConfig(loaded_data, mtime)
+            logger.info(f"Loaded configuration from {DATA_FILE}")
+        except Exception as e:
+            logger.error(f"Failed to load {DATA_FILE}: {str(e)}")
+            _config_failed_mtime = mtime
+            if _config is None:
+                raise ValueError(f"Failed to load {DATA_FILE}: {str(e)}")
+        return _config
+
+def setupGemini(systemPrompt: str, user_id: str, conversation_id: str, history: Optional[list] = None, generation_config=None):
+    if LLM_BACKEND == "fake":
+        import fake_llm
+        config = get_config()
+        return chat_sessions.get(user_id, conversation_id, systemPrompt, lambda: fake_llm.FakeChatSession(systemPrompt, config, history))
 
-def setupGemini(systemPrompt: str, user_id: str, conversation_id: str):
     genai_api_key = os.getenv("GENAI_APIKEY")
     genai_model = os.getenv("GENAI_MODEL")
     if not genai_api_key or not genai_model:
@@ -140,111 +828,957 @@ def setupGemini(systemPrompt: str, user_id: str, conversation_id: str):
         raise ValueError("Please set GENAI_APIKEY and GENAI_MODEL environment variables.")
     
     genai.configure(api_key=genai_api_key)
-    if user_id not in chat_sessions:
-        chat_sessions[user_id] = {}
-    if conversation_id not in chat_sessions[user_id]:
-        chat_sessions[user_id][conversation_id] = {}
-    if systemPrompt not in chat_sessions[user_id][conversation_id]:
+
+    def start_chat():
         try:
-            model = genai.GenerativeModel(model_name=genai_model, system_instruction=systemPrompt)
-            chat_sessions[user_id][conversation_id][systemPrompt] = model.start_chat()
+            model = genai.GenerativeModel(model_name=genai_model, system_instruction=systemPrompt, generation_config=generation_config)
+            return model.start_chat(history=history or [])
         except Exception as e:
             logger.error(f"Failed to setup Gemini model: {str(e)}")
             raise ValueError(f"Failed to setup Gemini model: {str(e)}")
-    return chat_sessions[user_id][conversation_id][systemPrompt]
+
+    return chat_sessions.get(user_id, conversation_id, systemPrompt, start_chat)
+
+# Merged intent + extraction
+# Gemini constrains the merged call to this schema; the reply is still checked
+# locally, and anything that does not validate sends the turn down the
+# separate intent and extraction calls.
+MERGED_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": ["general", "symptom"]},
+        "symptoms": {"type": "array", "items": {"type": "string"}},
+        "age": {"type": "string", "nullable": True},
+        "gender": {"type": "string", "nullable": True},
+        "previous_conditions": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["intent", "symptoms", "age", "gender", "previous_conditions"]
+}
+
+def parseMergedResponse(raw: str) -> Optional[dict]:
+    try:
+        parsed = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(parsed, dict) or parsed.get("intent") not in ("general", "symptom"):
+        return None
+    for key in ("symptoms", "previous_conditions"):
+        value = parsed.get(key) or []
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            return None
+        parsed[key] = value
+    for key in ("age", "gender"):
+        value = parsed.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(int(value))
+        if value is not None and not isinstance(value, str):
+            return None
+        parsed[key] = value or None
+    return parsed
+
+# Rebuilds Gemini chat history for a conversation that is not resident (new
+# worker, or evicted), as alternating user/model turns starting with the user
+def load_session_history(user_id: str, conversation_id: str, limit: int = SESSION_REBUILD_MESSAGES) -> list:
+    try:
+        with db_pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT sender, message FROM chats WHERE user_id = ? AND conversation_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, conversation_id, limit)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error loading session history: {str(e)}")
+        return []
+    history = []
+    for sender, message in reversed(rows):
+        role = "user" if sender == "user" else "model"
+        if history and history[-1]["role"] == role:
+            history[-1]["parts"].append(message)
+        elif history or role == "user":
+            history.append({"role": role, "parts": [message]})
+    if history and history[-1]["role"] == "user":
+        history.pop()
+    return history
+
+def _cleanGeminiText(response) -> str:
+    raw_text = response.text.strip()
+    clean_text = raw_text.replace("```json", "").replace("```", "").strip()
+    if not clean_text:
+        raise ValueError("Empty response from Gemini")
+    return clean_text
+
+GEMINI_ERROR_RESPONSE = '{"symptoms": [], "age": null, "gender": null, "previous_conditions": []}'
 
 def askGemini(prompt: str, geminiChat):
+    countLlmCall()
+    try:
+        return _cleanGeminiText(geminiChat.send_message(prompt))
+    except Exception as e:
+        logger.error(f"Gemini API error: {str(e)}")
+        countLlmError()
+        return GEMINI_ERROR_RESPONSE
+
+# Non-blocking variant for async endpoints; uses the SDK's async transport
+async def askGeminiAsync(prompt: str, geminiChat):
+    countLlmCall()
     try:
-        response = geminiChat.send_message(prompt)
-        raw_text = response.text.strip()
-        clean_text = raw_text.replace("```json", "").replace("```", "").strip()
+        return _cleanGeminiText(await geminiChat.send_message_async(prompt))
+    except Exception as e:
+        logger.error(f"Gemini API error: {str(e)}")
+        countLlmError()
+        return GEMINI_ERROR_RESPONSE
+
+# Streams the reply through on_token as chunks arrive; returns the full text
+async def askGeminiStream(prompt: str, geminiChat, on_token: Callable[[str], Awaitable[None]]):
+    countLlmCall()
+    try:
+        response = await geminiChat.send_message_async(prompt, stream=True)
+        chunks = []
+        async for chunk in response:
+            text = chunk.text
+            if text:
+                chunks.append(text)
+                await on_token(text)
+        clean_text = "".join(chunks).replace("```json", "").replace("```", "").strip()
         if not clean_text:
             raise ValueError("Empty response from Gemini")
         return clean_text
     except Exception as e:
         logger.error(f"Gemini API error: {str(e)}")
-        return '{"symptoms": [], "age": null, "gender": null, "previous_conditions": []}'
+        countLlmError()
+        return GEMINI_ERROR_RESPONSE
+
+# LLM response cache
+# Only for stages whose answer is a pure function of the prompt. Entries live in
+# an in-memory LRU and in the llm_cache table, so they survive restarts; both
+# tiers expire after LLM_CACHE_TTL seconds.
+class LLMResponseCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "stores": 0}
+
+    @staticmethod
+    def key(system_prompt: str, prompt: str) -> str:
+        normalized = " ".join(prompt.lower().split())
+        return hashlib.sha256(f"{system_prompt}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _remember(self, key: str, response: str, created_at: float):
+        with self._lock:
+            self._entries[key] = (response, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self._ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self._counters["memory_hits"] += 1
+            return entry[0]
 
-def convertUserResponseToDatasetStructure(input_symptoms, symptom_master_list):
+    def get_persistent(self, key: str) -> Optional[str]:
+        try:
+            with db_pool.connection() as conn:
+                row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Database error reading LLM cache: {str(e)}")
+            row = None
+        if row is None or time.time() - row[1] > self._ttl:
+            self._count("misses")
+            return None
+        self._remember(key, row[0], row[1])
+        self._count("persistent_hits")
+        return row[0]
+
+    def set(self, key: str, response: str):
+        created_at = time.time()
+        self._remember(key, response, created_at)
+        self._count("stores")
+        try:
+            with db_pool.connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, response, created_at) VALUES (?, ?, ?)",
+                    (key, response, created_at)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error writing LLM cache: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((lookups - stats["misses"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+llm_cache = LLMResponseCache(LLM_CACHE_SIZE, LLM_CACHE_TTL)
+
+async def askGeminiCached(prompt: str, geminiChat, system_prompt: str, validate: Optional[Callable[[str], Any]] = None):
+    key = llm_cache.key(system_prompt, prompt)
+    cached = llm_cache.get_memory(key)
+    if cached is None:
+        cached = await run_db(llm_cache.get_persistent, key)
+    if cached is not None:
+        return cached
+    response = await askGeminiAsync(prompt, geminiChat)
+    if response == GEMINI_ERROR_RESPONSE:
+        return response
+    if validate is not None:
+        try:
+            validate(response)
+        except Exception:
+            return response
+    await run_db(llm_cache.set, key, response)
+    return response
+
+# Pipeline stages
+# A stage runs once all of its deps have finished and receives their results as
+# keyword arguments. Independent stages run concurrently; a stage that fails or
+# exceeds its timeout yields its fallback instead of failing the whole turn.
+@dataclass
+class Stage:
+    run: Callable[..., Awaitable[Any]]
+    deps: Tuple[str, ...] = ()
+    timeout: float = LLM_STAGE_TIMEOUT
+    fallback: Any = None
+
+async def runStageGraph(stages: Dict[str, Stage]) -> Dict[str, Any]:
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def execute(name: str):
+        stage = stages[name]
+        inputs = {dep: await tasks[dep] for dep in stage.deps}
+        try:
+            return await asyncio.wait_for(stage.run(**inputs), stage.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stage '{name}' timed out after {stage.timeout}s, using fallback")
+        except Exception as e:
+            logger.error(f"Stage '{name}' failed, using fallback: {str(e)}")
+        return stage.fallback
+
+    # Every task exists before any of them runs, so deps can always be awaited
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(execute(name))
+    results = await asyncio.gather(*tasks.values())
+    return dict(zip(tasks, results))
+
+# Symptom index
+# Built once per symptom master list: normalized name -> column, synonyms from
+# data.json ("symptomSynonyms": {"wording": "master symptom"}), a token-sorted key
+# so "pain in chest" style reorderings match, and a trigram index for close wordings.
+# A fuzzy hit must also pair every content word with a word of the candidate
+# (equal or a close spelling) and never differ on a qualifier, so "decreased
+# appetite" cannot land on increased_appetite.
+def normalizeSymptom(symptom) -> str:
+    return " ".join(str(symptom).lower().replace("_", " ").replace("-", " ").split())
+
+_SYMPTOM_STOPWORDS = {"a", "an", "the", "in", "on", "of", "my", "at", "and", "with"}
+_SYMPTOM_QUALIFIERS = {
+    "increased", "decreased", "reduced", "excessive", "high", "low", "mild", "severe",
+    "loss", "no", "not", "left", "right", "upper", "lower", "acute", "chronic"
+}
+
+# Per-word similarity a misspelt word needs to pair with a candidate word; the
+# whole wording must still clear SYMPTOM_MATCH_THRESHOLD
+_WORD_MATCH_THRESHOLD = 0.5
+
+def _sortedKey(name: str) -> str:
+    return " ".join(sorted(w for w in name.split() if w not in _SYMPTOM_STOPWORDS))
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _dice(a: set, b: set) -> float:
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+def _sameWords(name: str, candidate: str, threshold: float = _WORD_MATCH_THRESHOLD) -> bool:
+    words = [w for w in name.split() if w not in _SYMPTOM_STOPWORDS]
+    remaining = [w for w in candidate.split() if w not in _SYMPTOM_STOPWORDS]
+    if len(words) != len(remaining):
+        return False
+    for word in words:
+        if word in remaining:
+            remaining.remove(word)
+            continue
+        if word in _SYMPTOM_QUALIFIERS:
+            return False
+        grams = _trigrams(word)
+        score, match = max((_dice(grams, _trigrams(other)), other) for other in remaining)
+        if score < threshold or match in _SYMPTOM_QUALIFIERS:
+            return False
+        remaining.remove(match)
+    return True
+
+_MISSING = object()
+
+class SymptomIndex:
+    def __init__(self, symptom_master_list, synonyms=None, threshold: float = SYMPTOM_MATCH_THRESHOLD):
+        self.size = len(symptom_master_list)
+        self.threshold = threshold
+        self.positions: Dict[str, int] = {}
+        self._sorted_positions: Dict[str, int] = {}
+        # Fuzzy candidates are master names and synonym wordings: (name, column, trigrams)
+        self._entries: List[Tuple[str, int, set]] = []
+        self._gram_index: Dict[str, List[int]] = {}
+        self._fuzzy_cache: Dict[str, Optional[int]] = {}
+        for pos, symptom in enumerate(symptom_master_list):
+            name = normalizeSymptom(symptom)
+            self.positions.setdefault(name, pos)
+            self._sorted_positions.setdefault(_sortedKey(name), pos)
+            self._addEntry(name, pos)
+        for wording, symptom in (synonyms or {}).items():
+            pos = self.positions.get(normalizeSymptom(symptom))
+            if pos is None:
+                logger.warning(f"Synonym '{wording}' points to unknown symptom '{symptom}'")
+                continue
+            self.positions.setdefault(normalizeSymptom(wording), pos)
+            self._addEntry(normalizeSymptom(wording), pos)
+
+    def _addEntry(self, name: str, pos: int):
+        grams = _trigrams(name)
+        for gram in grams:
+            self._gram_index.setdefault(gram, []).append(len(self._entries))
+        self._entries.append((name, pos, grams))
+
+    def _fuzzy(self, name: str) -> Optional[int]:
+        # One get(): another thread may clear() the cache between a check and a read
+        cached = self._fuzzy_cache.get(name, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        grams = _trigrams(name)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for entry in self._gram_index.get(gram, ()):
+                shared[entry] = shared.get(entry, 0) + 1
+        best, best_score = None, self.threshold
+        for entry, count in shared.items():
+            candidate, pos, candidate_grams = self._entries[entry]
+            score = 2 * count / (len(grams) + len(candidate_grams))
+            if score >= best_score and _sameWords(name, candidate):
+                best, best_score = pos, score
+        if len(self._fuzzy_cache) >= 10000:
+            self._fuzzy_cache.clear()
+        self._fuzzy_cache[name] = best
+        return best
+
+    def lookup(self, symptom) -> Optional[int]:
+        name = normalizeSymptom(symptom)
+        if not name:
+            return None
+        pos = self.positions.get(name)
+        if pos is None:
+            pos = self._sorted_positions.get(_sortedKey(name))
+        if pos is None:
+            pos = self._fuzzy(name)
+        return pos
+
+    def columns(self, symptoms) -> List[int]:
+        return [pos for pos in (self.lookup(s) for s in symptoms) if pos is not None]
+
+    def vectorize(self, symptoms) -> np.ndarray:
+        vector = np.zeros(self.size, dtype=np.uint8)
+        vector[self.columns(symptoms)] = 1
+        return vector
+
+    def matrix(self, symptom_lists) -> np.ndarray:
+        matrix = np.zeros((len(symptom_lists), self.size), dtype=np.uint8)
+        for row, symptoms in enumerate(symptom_lists):
+            matrix[row, self.columns(symptoms)] = 1
+        return matrix
+
+_symptom_indexes: Dict[tuple, SymptomIndex] = {}
+
+def getSymptomIndex(symptom_master_list, synonyms=None) -> SymptomIndex:
+    key = (tuple(symptom_master_list), tuple(sorted((synonyms or {}).items())))
+    index = _symptom_indexes.get(key)
+    if index is None:
+        index = SymptomIndex(symptom_master_list, synonyms)
+        _symptom_indexes.clear()
+        _symptom_indexes[key] = index
+    return index
+
+# Symptoms as a list, from a list, a JSON array string or a comma-separated string
+def parseSymptomList(input_symptoms) -> list:
     if isinstance(input_symptoms, str):
         cleaned_input = input_symptoms.replace("```json", "").replace("```", "").strip()
         try:
             input_symptoms = json.loads(cleaned_input)
         except json.JSONDecodeError:
             input_symptoms = [s.strip() for s in cleaned_input.split(",") if s.strip()]
-    elif not isinstance(input_symptoms, list):
+    if not isinstance(input_symptoms, list):
         input_symptoms = [str(input_symptoms)]
+    return input_symptoms
+
+def convertUserResponseToDatasetStructure(input_symptoms, symptom_master_list, synonyms=None):
+    input_symptoms = parseSymptomList(input_symptoms)
+
+    if isinstance(symptom_master_list, SymptomIndex):
+        return symptom_master_list.vectorize(input_symptoms)
+    return getSymptomIndex(symptom_master_list, synonyms).vectorize(input_symptoms)
+
+# Local intent classifier
+# Scores the user's message with hand-picked cues (symptom n-grams from the
+# symptom index, age/gender answers, greetings) plus TF-IDF similarity to past
+# messages labelled by the Gemini intent stage (intent_labels). Returns None
+# when the message is ambiguous so the caller falls back to Gemini. While the
+# conversation has a pending diagnosis the message is usually an answer to the
+# missing-field prompt ("34", "no, thank you"), so numbers count as an age
+# answer and the message is never settled as general locally.
+_GENERAL_CUES = {"hi", "hello", "hey", "thanks", "thank", "bye", "goodbye", "namaste"}
+_MEDICAL_CUES = {"pain", "ache", "aching", "suffering", "symptom", "symptoms", "feel", "feeling", "since", "days", "weeks"}
+_GENDER_CUES = {"male", "female", "man", "woman", "boy", "girl"}
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+class IntentClassifier:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._idf: Dict[str, float] = {}
+        self._centroids: Dict[str, Dict[str, float]] = {}
+        self._trained_on = 0
+        self._labels_since_fit = 0
+        self._counters = {"local_general": 0, "local_symptom": 0, "llm": 0}
+
+    @staticmethod
+    def _tokens(text: str) -> List[str]:
+        return _WORD_RE.findall(text.lower())
 
-    input_symptoms = [s.lower().strip() for s in input_symptoms]
-    symptom_master_list = [s.lower().strip() for s in symptom_master_list]
-    binary_vector = [1 if symptom in input_symptoms else 0 for symptom in symptom_master_list]
-    return binary_vector
+    def _vector(self, tokens: List[str], idf: Dict[str, float]) -> Dict[str, float]:
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            if token in idf:
+                counts[token] = counts.get(token, 0) + 1
+        vector = {token: count * idf[token] for token, count in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        return {token: v / norm for token, v in vector.items()} if norm else {}
+
+    def fit(self, labelled: List[Tuple[str, str]]):
+        documents = [(set(self._tokens(message)), intent) for message, intent in labelled]
+        if len({intent for _, intent in documents}) < 2:
+            return
+        df: Dict[str, int] = {}
+        for tokens, _ in documents:
+            for token in tokens:
+                df[token] = df.get(token, 0) + 1
+        idf = {token: math.log((1 + len(documents)) / (1 + count)) + 1 for token, count in df.items()}
+        sums: Dict[str, Dict[str, float]] = {}
+        for (message, intent) in labelled:
+            centroid = sums.setdefault(intent, {})
+            for token, weight in self._vector(self._tokens(message), idf).items():
+                centroid[token] = centroid.get(token, 0.0) + weight
+        centroids = {}
+        for intent, centroid in sums.items():
+            norm = math.sqrt(sum(v * v for v in centroid.values()))
+            centroids[intent] = {token: v / norm for token, v in centroid.items()}
+        with self._lock:
+            self._idf, self._centroids = idf, centroids
+            self._trained_on = len(labelled)
+            self._labels_since_fit = 0
+
+    def classify(self, text: str, symptom_index: "SymptomIndex", pending: bool = False) -> Tuple[Optional[str], float]:
+        tokens = self._tokens(text)
+        if not tokens:
+            return None, 0.0
+        ngrams = {" ".join(tokens[i:i + n]) for n in (1, 2, 3) for i in range(len(tokens) - n + 1)}
+        symptom_hits = sum(1 for gram in ngrams if gram in symptom_index.positions)
+        general_hits = sum(1 for token in tokens if token in _GENERAL_CUES)
+        medical_hits = sum(1 for token in tokens if token in _MEDICAL_CUES)
+        profile_answer = any(token in _GENDER_CUES for token in tokens) or (pending and any(token.isdigit() for token in tokens))
+        score = 3.0 * symptom_hits + 2.5 * profile_answer + 1.0 * medical_hits - 3.0 * general_hits
+        with self._lock:
+            idf, centroids = self._idf, self._centroids
+        if centroids:
+            vector = self._vector(tokens, idf)
+            similarity = {
+                intent: sum(weight * centroid.get(token, 0.0) for token, weight in vector.items())
+                for intent, centroid in centroids.items()
+            }
+            score += 4.0 * (similarity.get("symptom", 0.0) - similarity.get("general", 0.0))
+        p_symptom = 1 / (1 + math.exp(-score))
+        if p_symptom >= self.threshold:
+            return "symptom", p_symptom
+        if 1 - p_symptom >= self.threshold and not pending:
+            return "general", 1 - p_symptom
+        return None, max(p_symptom, 1 - p_symptom)
+
+    def count(self, path: str):
+        with self._lock:
+            self._counters[path] += 1
+
+    def label_recorded(self) -> bool:
+        with self._lock:
+            self._labels_since_fit += 1
+            return self._labels_since_fit >= INTENT_RETRAIN_EVERY
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["threshold"] = self.threshold
+            stats["trained_on"] = self._trained_on
+        total = stats["local_general"] + stats["local_symptom"] + stats["llm"]
+        stats["local_ratio"] = round((total - stats["llm"]) / total, 4) if total else 0.0
+        return stats
+
+intent_classifier = IntentClassifier(INTENT_CONFIDENCE_THRESHOLD)
+
+def train_intent_classifier():
+    try:
+        with db_pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT message, intent FROM intent_labels ORDER BY id DESC LIMIT ?",
+                (INTENT_TRAINING_LIMIT,)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error loading intent labels: {str(e)}")
+        return
+    intent_classifier.fit(rows)
+    logger.info(f"Intent classifier trained on {len(rows)} labelled messages")
+
+def record_intent_label(message: str, intent: str):
+    try:
+        with db_pool.connection() as conn:
+            conn.execute("INSERT INTO intent_labels (message, intent) VALUES (?, ?)", (message, intent))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Database error saving intent label: {str(e)}")
+        return
+    if intent_classifier.label_recorded():
+        train_intent_classifier()
+
+def _conversation_name(cursor, conversation_id: str, user_id: str) -> str:
+    cursor.execute(
+        "SELECT name FROM conversations WHERE user_id = ? AND conversation_id = ?",
+        (user_id, conversation_id)
+    )
+    result = cursor.fetchone()
+    if result and result[0]:
+        return result[0]
+
+    # Fallback: Check pending_chats for symptoms
+    cursor.execute(
+        """
+        SELECT symptoms
+        FROM pending_chats
+        WHERE user_id = ? AND conversation_id = ?
+        ORDER BY created_at DESC
+        LIMIT 1
+        """,
+        (user_id, conversation_id)
+    )
+    result = cursor.fetchone()
+    if result and result[0]:
+        symptoms = json.loads(result[0])
+        if symptoms:
+            return ", ".join(symptoms[:2])  # Use first two symptoms
+    # Final fallback: Use conversation_id
+    return f"Conversation {conversation_id[-6:]}"  # Last 6 digits for brevity
 
 def generate_conversation_name(conversation_id: str, user_id: str) -> str:
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        # Get the first user message
-        cursor.execute(
-            """
-            SELECT message
-            FROM chats
-            WHERE user_id = ? AND conversation_id = ? AND sender = 'user'
-            ORDER BY timestamp ASC
-            LIMIT 1
-            """,
-            (user_id, conversation_id)
-        )
-        result = cursor.fetchone()
-        if result:
-            message = result[0]
-            # Use first 30 characters of the message, trimmed
-            name = (message[:30] + "...") if len(message) > 30 else message
-            return name.strip()
-        
-        # Fallback: Check pending_chats for symptoms
-        cursor.execute(
-            """
-            SELECT symptoms
-            FROM pending_chats
-            WHERE user_id = ? AND conversation_id = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-            """,
-            (user_id, conversation_id)
-        )
-        result = cursor.fetchone()
-        if result and result[0]:
-            symptoms = json.loads(result[0])
-            if symptoms:
-                return ", ".join(symptoms[:2])  # Use first two symptoms
-        # Final fallback: Use conversation_id
-        return f"Conversation {conversation_id[-6:]}"  # Last 6 digits for brevity
+        with db_pool.connection() as conn:
+            return _conversation_name(conn.cursor(), conversation_id, user_id)
     except sqlite3.Error as e:
         logger.error(f"Database error in generate_conversation_name: {str(e)}")
         return f"Conversation {conversation_id[-6:]}"
-    finally:
-        conn.close()
 
-def predict_disease(input_list, model_path='disease_lr_model_with_encoder.joblib'):
+# Linear inference engine
+# A one-vs-rest bundle of linear estimators is exported into one coefficient
+# matrix (features x classes) and an intercept vector at load time. A binary
+# symptom vector is then scored by summing the coefficient rows of its active
+# symptoms, with no pandas or per-estimator calls. Probabilities follow
+# OneVsRestClassifier.predict_proba: per-class sigmoids normalised to sum to 1.
+class LinearEngine:
+    def __init__(self, coef: np.ndarray, intercept: np.ndarray, labels: np.ndarray):
+        self.coef = np.ascontiguousarray(coef.T, dtype=np.float64)
+        self.intercept = intercept.astype(np.float64)
+        self.labels = labels
+
+    @classmethod
+    def from_bundle(cls, bundle: dict) -> Optional["LinearEngine"]:
+        model = bundle["model"]
+        estimators = getattr(model, "estimators_", None)
+        if not estimators or len(estimators) < 3 or getattr(model, "multilabel_", False):
+            return None
+        if not all(hasattr(e, "coef_") and hasattr(e, "intercept_") and e.coef_.shape[0] == 1 for e in estimators):
+            return None
+        coef = np.vstack([e.coef_ for e in estimators])
+        intercept = np.concatenate([np.ravel(e.intercept_) for e in estimators])
+        labels = bundle["label_encoder"].inverse_transform(model.classes_)
+        return cls(coef, intercept, labels)
+
+    def scores(self, matrix) -> np.ndarray:
+        matrix = np.asarray(matrix, dtype=np.float64)
+        if matrix.ndim == 1:
+            return self.coef[np.flatnonzero(matrix)].sum(axis=0) + self.intercept
+        return matrix @ self.coef + self.intercept
+
+    def predict(self, matrix) -> np.ndarray:
+        return self.labels[np.argmax(self.scores(matrix), axis=-1)]
+
+    def probabilities(self, matrix) -> np.ndarray:
+        probabilities = 1.0 / (1.0 + np.exp(-self.scores(matrix)))
+        return probabilities / probabilities.sum(axis=-1, keepdims=True)
+
+    def top_k(self, vector, k: int) -> List[Tuple[str, float]]:
+        probabilities = self.probabilities(vector)
+        k = min(k, len(probabilities))
+        top = np.argpartition(-probabilities, k - 1)[:k]
+        top = top[np.argsort(-probabilities[top])]
+        return [(str(self.labels[i]), round(float(probabilities[i]), 4)) for i in top]
+
+# Model registry
+# Keeps every named model version resident. Files are re-checked in a background
+# thread at most every MODEL_CHECK_INTERVAL seconds; a changed file is loaded off
+# to the side and swapped in under the lock, so requests never wait on unpickling.
+# models.json (optional) looks like {"active": "v2", "versions": {"v1": "a.joblib", "v2": "b.joblib"}}
+class ModelRegistry:
+    def __init__(self, default_path: str, registry_file: Optional[str] = None, check_interval: float = 5.0):
+        self._lock = threading.Lock()
+        self._default_path = default_path
+        self._registry_file = registry_file
+        self._registry_mtime = None
+        self._check_interval = check_interval
+        self._last_check = 0.0
+        self._refreshing = False
+        self._paths: Dict[str, str] = {"default": default_path}
+        self._entries: Dict[str, dict] = {}
+        self._active = "default"
+
+    @staticmethod
+    def _load_entry(path: str) -> dict:
+        with open(path, "rb") as f:
+            raw = f.read()
+        bundle = joblib.load(io.BytesIO(raw))
+        if "model" not in bundle or "label_encoder" not in bundle:
+            raise ValueError(f"Model bundle {path} must contain 'model' and 'label_encoder'")
+        engine = LinearEngine.from_bundle(bundle)
+        if engine is None:
+            logger.warning(f"Model bundle {path} is not a linear one-vs-rest model; using sklearn predict")
+        return {
+            "path": path,
+            "bundle": bundle,
+            "engine": engine,
+            "mtime": os.path.getmtime(path),
+            "sha256": hashlib.sha256(raw).hexdigest(),
+            "loaded_at": datetime.now().isoformat()
+        }
+
+    def _read_registry_file(self):
+        if not self._registry_file or not os.path.exists(self._registry_file):
+            return None
+        mtime = os.path.getmtime(self._registry_file)
+        if mtime == self._registry_mtime:
+            return None
+        with open(self._registry_file, "r") as f:
+            config = json.load(f)
+        self._registry_mtime = mtime
+        versions = config.get("versions") or {"default": self._default_path}
+        active = config.get("active", next(iter(versions)))
+        if active not in versions:
+            raise ValueError(f"Active model '{active}' is not listed in {self._registry_file}")
+        return versions, active
+
+    def refresh(self):
+        try:
+            registry = self._read_registry_file()
+        except Exception as e:
+            logger.error(f"Failed to read model registry file: {str(e)}")
+            registry = None
+        if registry:
+            versions, active = registry
+            with self._lock:
+                entry = self._entries.get(active)
+            try:
+                if not entry or entry["path"] != versions[active] or os.path.getmtime(versions[active]) != entry["mtime"]:
+                    entry = self._load_entry(versions[active])
+            except Exception as e:
+                # Keep serving the current version; clearing the mtime retries the edit on the next check
+                logger.error(f"Failed to load active model '{active}' from {versions[active]}, keeping '{self._active}': {str(e)}")
+                with self._lock:
+                    self._registry_mtime = None
+                    self._last_check = time.monotonic()
+                return
+            with self._lock:
+                self._paths = dict(versions)
+                self._entries[active] = entry
+            self._sync_versions()
+            self.activate(active)
+        else:
+            self._sync_versions()
+        with self._lock:
+            self._last_check = time.monotonic()
+
+    def _sync_versions(self):
+        with self._lock:
+            paths = dict(self._paths)
+            entries = dict(self._entries)
+        for name, path in paths.items():
+            entry = entries.get(name)
+            try:
+                if entry and entry["path"] == path and os.path.getmtime(path) == entry["mtime"]:
+                    continue
+                new_entry = self._load_entry(path)
+            except Exception as e:
+                logger.error(f"Failed to load model '{name}' from {path}: {str(e)}")
+                continue
+            if entry and entry["sha256"] == new_entry["sha256"]:
+                entry["mtime"] = new_entry["mtime"]
+                continue
+            with self._lock:
+                self._entries[name] = new_entry
+            logger.info(f"Loaded model '{name}' from {path} (sha256 {new_entry['sha256'][:12]})")
+        with self._lock:
+            for name in list(self._entries):
+                if name not in self._paths:
+                    del self._entries[name]
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def register(self, name: str, path: str, activate: bool = False):
+        entry = self._load_entry(path)
+        with self._lock:
+            self._paths[name] = path
+            self._entries[name] = entry
+            if activate:
+                self._active = name
+        logger.info(f"Registered model '{name}' from {path}")
+
+    def activate(self, name: str):
+        with self._lock:
+            if name not in self._paths:
+                raise ValueError(f"Unknown model version '{name}'")
+            loaded = name in self._entries
+        if not loaded:
+            self.register(name, self._paths[name])
+        with self._lock:
+            if self._active != name:
+                logger.info(f"Switching active model from '{self._active}' to '{name}'")
+            self._active = name
+
+    def has(self, name: str) -> bool:
+        with self._lock:
+            return name in self._paths
+
+    def get(self, name: Optional[str] = None) -> dict:
+        return self._entry(name)["bundle"]
+
+    def engine(self, name: Optional[str] = None) -> Optional[LinearEngine]:
+        return self._entry(name)["engine"]
+
+    def _entry(self, name: Optional[str]) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            if not self._refreshing and now - self._last_check >= self._check_interval:
+                self._last_check = now
+                self._refreshing = True
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+            name = name or self._active
+            entry = self._entries.get(name)
+            path = self._paths.get(name)
+        if entry is None:
+            if path is None:
+                raise ValueError(f"Unknown model version '{name}'")
+            # Not preloaded (startup failed or a new version); load it on this request
+            self.register(name, path)
+            with self._lock:
+                entry = self._entries[name]
+        return entry
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "versions": {
+                    name: {
+                        "path": path,
+                        "loaded": name in self._entries,
+                        "sha256": self._entries[name]["sha256"] if name in self._entries else None,
+                        "loaded_at": self._entries[name]["loaded_at"] if name in self._entries else None
+                    }
+                    for name, path in self._paths.items()
+                }
+            }
+
+model_registry = ModelRegistry(MODEL_PATH, MODEL_REGISTRY_FILE, MODEL_CHECK_INTERVAL)
+
+@app.on_event("startup")
+def load_models():
+    model_registry.refresh()
+    # Warm the config cache; a missing data.json is still reported per request
+    try:
+        get_config()
+    except ValueError:
+        pass
+    train_intent_classifier()
+    load_rog_mappings()
+
+def predict_disease(input_list, model_name: Optional[str] = None):
     try:
-        bundle = joblib.load(model_path)
-        model = bundle['model']
-        encoder = bundle['label_encoder']
-        input_df = pd.DataFrame([input_list], columns=model.estimators_[0].feature_names_in_)
         if sum(input_list) == 0:
             return "No disease predicted (no symptoms matched)"
-        pred_encoded = model.predict(input_df)
-        prediction = encoder.inverse_transform(pred_encoded)[0]
+        engine = model_registry.engine(model_name)
+        if engine is not None:
+            prediction = engine.predict(input_list)
+        else:
+            bundle = model_registry.get(model_name)
+            model = bundle['model']
+            input_df = pd.DataFrame([input_list], columns=model.estimators_[0].feature_names_in_)
+            prediction = bundle['label_encoder'].inverse_transform(model.predict(input_df))[0]
         logger.info(f"Model prediction: {prediction}")
         return prediction
     except Exception as e:
         logger.error(f"Prediction error: {str(e)}")
         raise ValueError(f"Prediction error: {str(e)}")
 
-def classifyDisease(disease: str, symptoms, geminiChat):
-    userPrompt = f"Diseases: {disease}\nSymptoms: {', '.join(symptoms)}"
-    return askGemini(userPrompt, geminiChat).strip()
+# Ranked differential as [(disease, probability), ...], most likely first
+def predict_disease_top_k(input_list, k: int = PREDICTION_TOP_K, model_name: Optional[str] = None) -> List[Tuple[str, float]]:
+    try:
+        engine = model_registry.engine(model_name)
+        if engine is not None:
+            ranked = engine.top_k(input_list, k)
+        else:
+            bundle = model_registry.get(model_name)
+            model = bundle['model']
+            input_df = pd.DataFrame([input_list], columns=model.estimators_[0].feature_names_in_)
+            probabilities = model.predict_proba(input_df)[0]
+            top = np.argsort(-probabilities)[:k]
+            labels = bundle['label_encoder'].inverse_transform(model.classes_[top])
+            ranked = [(str(label), round(float(probabilities[i]), 4)) for label, i in zip(labels, top)]
+        logger.info(f"Model prediction: {ranked}")
+        return ranked
+    except Exception as e:
+        logger.error(f"Prediction error: {str(e)}")
+        raise ValueError(f"Prediction error: {str(e)}")
+
+# Ranked differential for many records at once: ([[(disease, probability), ...]
+# per record, empty when no symptom matched], matched symptom counts). Used by
+# /predict_batch and the offline bulk_score.py CLI.
+def predict_diseases_batch_top_k(symptom_lists, symptom_master_list, k: int = PREDICTION_TOP_K, model_name: Optional[str] = None, synonyms=None):
+    index = symptom_master_list if isinstance(symptom_master_list, SymptomIndex) else getSymptomIndex(symptom_master_list, synonyms)
+    try:
+        engine = model_registry.engine(model_name)
+        matrix = index.matrix(symptom_lists)
+        matched = matrix.sum(axis=1)
+        rankings: List[List[Tuple[str, float]]] = [[] for _ in symptom_lists]
+        rows = np.flatnonzero(matched)
+        if len(rows):
+            if engine is not None:
+                probabilities = engine.probabilities(matrix[rows])
+                labels = engine.labels
+            else:
+                bundle = model_registry.get(model_name)
+                model = bundle['model']
+                input_df = pd.DataFrame(matrix[rows], columns=model.estimators_[0].feature_names_in_)
+                probabilities = model.predict_proba(input_df)
+                labels = bundle['label_encoder'].inverse_transform(model.classes_)
+            top = np.argsort(-probabilities, axis=1)[:, :k]
+            for position, row in enumerate(rows):
+                rankings[row] = [(str(labels[i]), round(float(probabilities[position, i]), 4)) for i in top[position]]
+        logger.info(f"Batch prediction: {len(symptom_lists)} records, {len(rows)} with matched symptoms")
+        return rankings, matched.tolist()
+    except Exception as e:
+        logger.error(f"Batch prediction error: {str(e)}")
+        raise ValueError(f"Batch prediction error: {str(e)}")
+
+def predict_diseases_batch(symptom_lists, symptom_master_list, model_name: Optional[str] = None, synonyms=None):
+    rankings, matched = predict_diseases_batch_top_k(symptom_lists, symptom_master_list, 1, model_name, synonyms)
+    return [ranked[0][0] if ranked else "No disease predicted (no symptoms matched)" for ranked in rankings], matched
+
+# Disease -> Ayurvedic rog resolution
+# ayurvedicHash and the medicine data keys are indexed by normalised name (case,
+# spacing, underscores and word order ignored). There is deliberately no fuzzy
+# matching: near-identical names such as Hypothyroidism/Hyperthyroidism or
+# Hepatitis A/B are different conditions. Diseases missing from the table go to
+# Gemini; an answer that names a medicine key exactly is stored in rog_mappings
+# and answered locally from then on.
+class RogIndex:
+    def __init__(self, ayurvedic_hash: Mapping[str, str], medicine_data: Mapping[str, list]):
+        self._rogs: Dict[str, str] = {}
+        for disease, rog in ayurvedic_hash.items():
+            if isinstance(rog, str):
+                self._add(self._rogs, disease, rog)
+        self._medicine_keys: Dict[str, str] = {}
+        for key in medicine_data:
+            self._add(self._medicine_keys, key, key)
+
+    @staticmethod
+    def _add(table: Dict[str, str], name: str, value: str):
+        normalized = normalizeSymptom(name)
+        table.setdefault(normalized, value)
+        table.setdefault(_sortedKey(normalized), value)
+
+    @staticmethod
+    def _get(table: Dict[str, str], name: str) -> Optional[str]:
+        normalized = normalizeSymptom(name)
+        return table.get(normalized) or table.get(_sortedKey(normalized))
+
+    def medicine_key(self, rog: str) -> Optional[str]:
+        return self._get(self._medicine_keys, rog)
+
+    def lookup(self, disease: str) -> Optional[str]:
+        rog = self._get(self._rogs, disease)
+        if rog is None:
+            return None
+        return self.medicine_key(rog) or rog
+
+_learned_rogs: Dict[str, str] = {}
+
+def load_rog_mappings():
+    try:
+        with db_pool.connection() as conn:
+            rows = conn.execute("SELECT disease, rog FROM rog_mappings").fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error loading rog mappings: {str(e)}")
+        return
+    _learned_rogs.update((normalizeSymptom(disease), rog) for disease, rog in rows)
+    logger.info(f"Loaded {len(rows)} learned disease to rog mappings")
+
+def learn_rog_mapping(disease: str, rog: str):
+    _learned_rogs[normalizeSymptom(disease)] = rog
+    try:
+        with db_pool.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO rog_mappings (disease, rog) VALUES (?, ?)", (disease, rog))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Database error saving rog mapping: {str(e)}")
+
+def resolveRog(disease: str, config: AppConfig) -> Optional[str]:
+    return config.rog_index.lookup(disease) or _learned_rogs.get(normalizeSymptom(disease))
+
+async def classifyDisease(disease: str, symptoms, geminiChat, system_prompt: Optional[str] = None):
+    config = get_config()
+    rog = resolveRog(disease, config)
+    if rog is not None:
+        pipeline_metrics.count("rog_local_total")
+        return rog
+    userPrompt = f"Diseases: {disease}\nSymptoms: {', '.join(sorted(symptoms))}"
+    if system_prompt is None:
+        answer = (await askGeminiAsync(userPrompt, geminiChat)).strip()
+    else:
+        answer = (await askGeminiCached(userPrompt, geminiChat, system_prompt)).strip()
+    medicine_key = config.rog_index.medicine_key(answer) if answer != GEMINI_ERROR_RESPONSE else None
+    if medicine_key is None:
+        return answer
+    await run_db(learn_rog_mapping, disease, medicine_key)
+    return medicine_key
 
 def getKeyValuesfromMedicineJson(jsonData, key: str):
     return jsonData.get(key, [])
@@ -258,56 +1792,217 @@ def listCleaner(response):
             return [cleaned]
     return response
 
+def _replace_pending_chat(cursor, user_id: str, conversation_id: str, symptoms: list, age: str, gender: str, previous_conditions: list):
+    cursor.execute("DELETE FROM pending_chats WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+    cursor.execute(
+        "INSERT INTO pending_chats (user_id, conversation_id, symptoms, age, gender, previous_conditions) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, conversation_id, json.dumps(symptoms), age, gender, json.dumps(previous_conditions))
+    )
+
 def save_pending_chat(user_id: str, conversation_id: str, symptoms: list, age: str, gender: str, previous_conditions: list):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM pending_chats WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
-        cursor.execute(
-            "INSERT INTO pending_chats (user_id, conversation_id, symptoms, age, gender, previous_conditions) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, conversation_id, json.dumps(symptoms), age, gender, json.dumps(previous_conditions))
-        )
-        conn.commit()
+        with db_pool.connection() as conn:
+            _replace_pending_chat(conn.cursor(), user_id, conversation_id, symptoms, age, gender, previous_conditions)
+            conn.commit()
     except sqlite3.Error as e:
         logger.error(f"Database error in save_pending_chat: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to save pending chat")
-    finally:
-        conn.close()
 
 def get_current_pending_chat(user_id: str, conversation_id: str):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT symptoms, age, gender, previous_conditions FROM pending_chats WHERE user_id = ? AND conversation_id = ? ORDER BY created_at DESC LIMIT 1",
-            (user_id, conversation_id)
-        )
-        result = cursor.fetchone()
-        if result:
-            return {
-                "symptoms": json.loads(result[0]) if result[0] else [],
-                "age": result[1],
-                "gender": result[2],
-                "previous_conditions": json.loads(result[3]) if result[3] else []
-            }
-        return {"symptoms": [], "age": None, "gender": None, "previous_conditions": []}
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT symptoms, age, gender, previous_conditions FROM pending_chats WHERE user_id = ? AND conversation_id = ? ORDER BY created_at DESC LIMIT 1",
+                (user_id, conversation_id)
+            )
+            result = cursor.fetchone()
+            if result:
+                return {
+                    "symptoms": json.loads(result[0]) if result[0] else [],
+                    "age": result[1],
+                    "gender": result[2],
+                    "previous_conditions": json.loads(result[3]) if result[3] else []
+                }
+            return {"symptoms": [], "age": None, "gender": None, "previous_conditions": []}
     except sqlite3.Error as e:
         logger.error(f"Database error in get_current_pending_chat: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to retrieve pending chat")
-    finally:
-        conn.close()
+
+def _delete_pending_chat(cursor, user_id: str, conversation_id: str):
+    cursor.execute("DELETE FROM pending_chats WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
 
 def delete_pending_chat(user_id: str, conversation_id: str):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM pending_chats WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
-        conn.commit()
+        with db_pool.connection() as conn:
+            _delete_pending_chat(conn.cursor(), user_id, conversation_id)
+            conn.commit()
     except sqlite3.Error as e:
         logger.error(f"Database error in delete_pending_chat: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to delete pending chat")
-    finally:
-        conn.close()
+
+# Stored messages in a conversation (0 if it does not exist yet); it doubles as
+# the version number the session cache compares against
+def conversation_message_count(user_id: str, conversation_id: str) -> int:
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT message_count FROM conversations WHERE user_id = ? AND conversation_id = ?",
+                (user_id, conversation_id)
+            )
+            row = cursor.fetchone()
+            return row[0] if row else 0
+    except sqlite3.Error as e:
+        logger.error(f"Database error in predict conversation check: {str(e)}")
+        raise HTTPException(status_code=500, detail="Database error")
+
+# Context builder
+# A conversation's prompt context is a rolling summary of its older turns plus
+# the last CONTEXT_WINDOW_MESSAGES messages verbatim, in order. Messages that
+# slide out of the window are folded into the summary stored in
+# conversation_summaries, so each message is condensed once. The summary is
+# extractive (no extra LLM call), and only its newest lines are kept within
+# CONTEXT_SUMMARY_TOKENS. buildContext then fits it into each stage's budget.
+def estimateTokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "..."
+
+def foldSummary(summary: str, rows) -> str:
+    lines = summary.splitlines() if summary else []
+    for _, sender, message in rows:
+        if sender == "user":
+            lines.append(f"- User: {_clip(message, 160)}")
+        else:
+            first_line = message.split("\n", 1)[0]
+            lines.append(f"- Assistant: {_clip(first_line, 120)}")
+    while len(lines) > 1 and estimateTokens("\n".join(lines)) > CONTEXT_SUMMARY_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+def load_conversation_context(user_id: str, conversation_id: str) -> Tuple[str, list]:
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT summary, last_chat_id FROM conversation_summaries WHERE user_id = ? AND conversation_id = ?",
+                (user_id, conversation_id)
+            )
+            row = cursor.fetchone()
+            summary, last_chat_id = row if row else ("", 0)
+            cursor.execute(
+                "SELECT id, sender, message FROM chats WHERE user_id = ? AND conversation_id = ? AND id > ? ORDER BY id DESC LIMIT ?",
+                (user_id, conversation_id, last_chat_id, CONTEXT_WINDOW_MESSAGES * 4)
+            )
+            rows = cursor.fetchall()[::-1]
+            window = rows[-CONTEXT_WINDOW_MESSAGES:]
+            folded = rows[:-CONTEXT_WINDOW_MESSAGES]
+            if folded:
+                summary = foldSummary(summary, folded)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO conversation_summaries (user_id, conversation_id, summary, last_chat_id) VALUES (?, ?, ?, ?)",
+                    (user_id, conversation_id, summary, folded[-1][0])
+                )
+                conn.commit()
+            return summary, window
+    except sqlite3.Error as e:
+        logger.error(f"Database error fetching chat history: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to fetch chat history")
+
+def buildContext(summary: str, window: list, user_input: str, budget: int) -> str:
+    if not summary and not window:
+        return user_input
+    remaining = budget - estimateTokens(user_input)
+    lines = []
+    for _, sender, message in reversed(window):
+        line = f"User: {_clip(message, CONTEXT_REPLY_CHARS * 2)}" if sender == "user" else f"Assistant: {_clip(message, CONTEXT_REPLY_CHARS)}"
+        cost = estimateTokens(line)
+        if cost > remaining:
+            break
+        lines.append(line)
+        remaining -= cost
+    lines.reverse()
+    if summary and len(lines) == len(window):
+        block = f"Earlier in this conversation:\n{summary}"
+        if estimateTokens(block) <= remaining:
+            lines.insert(0, block)
+    return "\n".join(lines + [f"User: {user_input}"])
+
+# Drops the oldest request/response pairs from a session until its history fits
+# the budget; the Gemini SDK resends the whole history on every call
+def trimSessionHistory(session, budget: int = SESSION_HISTORY_TOKENS):
+    try:
+        history = list(session.history)
+    except Exception:
+        return
+    tokens = sum(_contentChars(content) for content in history) // 4
+    drop = 0
+    while tokens > budget and len(history) - drop > 2:
+        tokens -= (_contentChars(history[drop]) + _contentChars(history[drop + 1])) // 4
+        drop += 2
+    if drop:
+        session.history = history[drop:]
+
+# chats has UNIQUE(user_id, conversation_id, timestamp), so second-resolution
+# CURRENT_TIMESTAMP collides when a turn finishes within the same second.
+# Millisecond UTC timestamps, kept strictly increasing, still sort after the
+# older second-resolution rows.
+_last_chat_time = datetime.min
+_chat_time_lock = threading.Lock()
+
+def chat_timestamp() -> str:
+    global _last_chat_time
+    with _chat_time_lock:
+        now = datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        if now <= _last_chat_time:
+            now = _last_chat_time + timedelta(milliseconds=1)
+        _last_chat_time = now
+    return now.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def _insert_chat_message(cursor, user_id: str, conversation_id: str, sender: str, message: str, timestamp: str):
+    cursor.execute(
+        "INSERT INTO chats (user_id, conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+        (user_id, conversation_id, sender, message, timestamp)
+    )
+
+# Unit of work for one /predict turn. The messages and pending-chat changes are
+# queued while the pipeline runs and written by commit() in one transaction, so
+# a turn costs a single commit and a failed turn leaves nothing half-written.
+# Message timestamps are taken when queued to keep the user message first.
+class TurnWrites:
+    def __init__(self, user_id: str, conversation_id: str):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self._ops = []
+        self.messages = 0
+
+    def add_message(self, sender: str, message: str):
+        self._ops.append((_insert_chat_message, (sender, message, chat_timestamp())))
+        self.messages += 1
+
+    def save_pending(self, symptoms: list, age: str, gender: str, previous_conditions: list):
+        self._ops.append((_replace_pending_chat, (symptoms, age, gender, previous_conditions)))
+
+    def delete_pending(self):
+        self._ops.append((_delete_pending_chat, ()))
+
+    def commit(self):
+        ops, self._ops = self._ops, []
+        if not ops:
+            return
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                for op, args in ops:
+                    op(cursor, self.user_id, self.conversation_id, *args)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Database error saving turn for conversation {self.conversation_id}: {str(e)}")
+            raise HTTPException(status_code=500, detail="Failed to save conversation turn")
 
 # Authentication utilities
 def verify_password(plain_password, hashed_password):
@@ -323,6 +2018,55 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+async def run_auth(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(auth_executor, functools.partial(func, *args))
+
+# Short-TTL cache of users rows keyed by username (the token subject), so the
+# auth dependency does not hit SQLite on every request. Only found users are
+# cached; anything that changes or removes a user must call invalidate().
+class UserCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, username: str) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or now - entry[0] > self._ttl:
+                if entry is not None:
+                    del self._entries[username]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, username: str, user: dict):
+        with self._lock:
+            self._entries[username] = (time.monotonic(), user)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: Optional[str] = None):
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -331,20 +2075,24 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             raise HTTPException(status_code=401, detail="Invalid token")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    
+    user = user_cache.get(username)
+    if user is None:
+        user = await run_db(load_user, username)
+        user_cache.put(username, user)
+    return user
+
+def load_user(username: str):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, email FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return {"id": user[0], "username": user[1], "email": user[2]}
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, username, email FROM users WHERE username = ?", (username,))
+            user = cursor.fetchone()
+            if user is None:
+                raise HTTPException(status_code=401, detail="User not found")
+            return {"id": user[0], "username": user[1], "email": user[2]}
     except sqlite3.Error as e:
         logger.error(f"Database error in get_current_user: {str(e)}")
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
 
 # Static content endpoints
 @app.get("/about")
@@ -403,129 +2151,190 @@ def get_contact():
     }
 
 # Authentication endpoints
-@app.post("/signup")
-def signup(user: UserCreate):
+# The bcrypt work runs on auth_executor between the database steps, so no pooled
+# connection is held while a password is hashed or checked.
+def user_exists(username: str, email: str) -> bool:
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?", (user.username, user.email))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Username or email already exists")
-        
-        hashed_password = get_password_hash(user.password)
-        cursor.execute(
-            "INSERT INTO users (username, email, hashed_password) VALUES (?, ?, ?)",
-            (user.username, user.email, hashed_password)
-        )
-        conn.commit()
-        return {"message": "User created successfully"}
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM users WHERE username = ? OR email = ?", (username, email))
+            return cursor.fetchone() is not None
     except sqlite3.Error as e:
         logger.error(f"Database error in signup: {str(e)}")
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
 
-@app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
+def create_user(username: str, email: str, hashed_password: str):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, hashed_password FROM users WHERE username = ?", (form_data.username,))
-        user = cursor.fetchone()
-        if not user or not verify_password(form_data.password, user[2]):
-            raise HTTPException(status_code=401, detail="Invalid username or password")
-        
-        access_token = create_access_token(data={"sub": user[1]})
-        return {"access_token": access_token, "token_type": "bearer"}
+        with db_pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO users (username, email, hashed_password) VALUES (?, ?, ?)",
+                (username, email, hashed_password)
+            )
+            conn.commit()
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=400, detail="Username or email already exists")
+    except sqlite3.Error as e:
+        logger.error(f"Database error in signup: {str(e)}")
+        raise HTTPException(status_code=500, detail="Database error")
+    user_cache.invalidate(username)
+
+def load_login(username: str):
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, username, hashed_password FROM users WHERE username = ?", (username,))
+            return cursor.fetchone()
     except sqlite3.Error as e:
         logger.error(f"Database error in login: {str(e)}")
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
+
+@app.post("/signup")
+async def signup(user: UserCreate):
+    if await run_db(user_exists, user.username, user.email):
+        raise HTTPException(status_code=400, detail="Username or email already exists")
+    hashed_password = await run_auth(get_password_hash, user.password)
+    await run_db(create_user, user.username, user.email, hashed_password)
+    return {"message": "User created successfully"}
+
+@app.post("/login")
+async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await run_db(load_login, form_data.username)
+    if not user or not await run_auth(verify_password, form_data.password, user[2]):
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    access_token = create_access_token(data={"sub": user[1]})
+    return {"access_token": access_token, "token_type": "bearer"}
 
 # Updated predict endpoint
-@app.post("/predict")
-async def predict(data: InputData, current_user: dict = Depends(get_current_user)):
+# One chat turn. notify, when given, receives ("stage", {...}) progress events
+# and ("token", {"text": ...}) chunks of the reply as they are generated. Stage
+# timings are recorded on timer and in pipeline_metrics.
+async def processTurn(data: InputData, current_user: dict, notify: Optional[Callable[[str, dict], Awaitable[None]]] = None, timer: Optional[TurnTimer] = None):
+    timer = timer or TurnTimer()
+    token = current_turn.set(timer)
+    try:
+        with timer.span("total"):
+            return await _runTurn(data, current_user, notify, timer)
+    finally:
+        current_turn.reset(token)
+        pipeline_metrics.finish_turn(timer)
+
+async def _runTurn(data: InputData, current_user: dict, notify: Optional[Callable[[str, dict], Awaitable[None]]], timer: TurnTimer):
     user_id = current_user["id"]
     conversation_id = data.conversation_id
 
+    async def stage(name: str, **details):
+        if notify is not None:
+            await notify("stage", {"stage": name, **details})
+
+    async def on_token(text: str):
+        await notify("token", {"text": text})
+
+    async def reply(prompt: str, geminiChat):
+        if notify is None:
+            return await askGeminiAsync(prompt, geminiChat)
+        return await askGeminiStream(prompt, geminiChat, on_token)
+
     # Validate or generate conversation_id
+    message_count = 0
     if not conversation_id:
         conversation_id = datetime.now().strftime("%Y%m%d%H%M%S%f")  # More unique ID
         logger.info(f"Generated new conversation_id: {conversation_id} for user_id: {user_id}")
     else:
         # Check if conversation_id exists for this user
-        try:
-            conn = sqlite3.connect("ayurvaid.db")
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id FROM chats WHERE user_id = ? AND conversation_id = ? LIMIT 1",
-                (user_id, conversation_id)
-            )
-            if not cursor.fetchone() and data.user_input:
-                logger.warning(f"Conversation_id {conversation_id} not found for user_id: {user_id}, treating as new")
-        except sqlite3.Error as e:
-            logger.error(f"Database error in predict conversation check: {str(e)}")
-            raise HTTPException(status_code=500, detail="Database error")
-        finally:
-            conn.close()
+        # Restore whenever an archive row exists: maintenance may have archived the
+        # conversation while an earlier turn was in flight, leaving that turn's
+        # messages in chats and the older ones in the archive
+        await run_db(restore_archived_conversation, user_id, conversation_id)
+        message_count = await run_db(conversation_message_count, user_id, conversation_id)
+        if not message_count and data.user_input:
+            logger.warning(f"Conversation_id {conversation_id} not found for user_id: {user_id}, treating as new")
 
     try:
-        systemPrompt, symptom_master_list, ayurvedicHash, ayurvedicSystemPrompt, aryuvedicMedicineData, finalResponseSystemPrompt, conversationalPrompt, intentPrompt, adjustmentPrompt = loadDataFromJson()
+        config = get_config()
     except Exception as e:
         logger.error(f"Error loading data in predict: {str(e)}")
         return {"error": f"Error loading data: {str(e)}", "conversation_id": conversation_id}
 
     try:
-        geminiIntentChat = setupGemini(intentPrompt, user_id, conversation_id)
-        geminiConversationalChat = setupGemini(conversationalPrompt, user_id, conversation_id)
-        geminiDiseaseChat = setupGemini(systemPrompt, user_id, conversation_id)
-        geminiAryuvedicChat = setupGemini(ayurvedicSystemPrompt, user_id, conversation_id)
-        geminiFinalResponseChat = setupGemini(finalResponseSystemPrompt, user_id, conversation_id)
-        geminiAdjustmentChat = setupGemini(adjustmentPrompt, user_id, conversation_id)
+        # Only the conversational and extraction sessions need prior turns replayed
+        with timer.span("session_setup"):
+            history = None
+            if chat_sessions.version(user_id, conversation_id) != message_count:
+                # Not resident here, or stale because another worker took turns since
+                chat_sessions.discard(user_id, conversation_id)
+                if message_count:
+                    history = await run_db(load_session_history, user_id, conversation_id)
+            geminiIntentChat = setupGemini(config.intent_prompt, user_id, conversation_id)
+            geminiConversationalChat = setupGemini(config.conversational_prompt, user_id, conversation_id, history)
+            geminiDiseaseChat = setupGemini(config.system_prompt, user_id, conversation_id, history)
+            geminiAryuvedicChat = setupGemini(config.ayurvedic_system_prompt, user_id, conversation_id)
+            geminiFinalResponseChat = setupGemini(config.final_response_system_prompt, user_id, conversation_id)
+            geminiAdjustmentChat = setupGemini(config.adjustment_prompt, user_id, conversation_id)
+            geminiMergedChat = None
+            if INTENT_EXTRACTION_MODE == "merged":
+                geminiMergedChat = setupGemini(
+                    config.merged_prompt, user_id, conversation_id, history,
+                    generation_config={"response_mime_type": "application/json", "response_schema": MERGED_RESPONSE_SCHEMA}
+                )
     except Exception as e:
         logger.error(f"Error setting up Gemini in predict: {str(e)}")
         return {"error": f"Error setting up AI model: {str(e)}", "conversation_id": conversation_id}
 
     # Fetch chat history
-    try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT message FROM chats WHERE user_id = ? AND conversation_id = ? ORDER BY timestamp DESC LIMIT 5",
-            (user_id, conversation_id)
-        )
-        chat_history = [row[0] for row in cursor.fetchall()]
-    except sqlite3.Error as e:
-        logger.error(f"Database error fetching chat history: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to fetch chat history")
-    finally:
-        conn.close()
+    with timer.span("history"):
+        summary, window = await run_db(load_conversation_context, user_id, conversation_id) if message_count else ("", [])
+        for session in (geminiIntentChat, geminiConversationalChat, geminiDiseaseChat, geminiMergedChat):
+            if session is not None:
+                trimSessionHistory(session)
 
-    context_prompt = "\n".join(chat_history) + "\nUser: " + data.user_input if chat_history else data.user_input
+    def context(stage: str) -> str:
+        return buildContext(summary, window, data.user_input, CONTEXT_BUDGETS[stage])
 
     # Save user message
-    try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chats (user_id, conversation_id, sender, message) VALUES (?, ?, ?, ?)",
-            (user_id, conversation_id, "user", data.user_input)
-        )
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Database error saving user message: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to save user message")
-    finally:
-        conn.close()
+    writes = TurnWrites(user_id, conversation_id)
+    writes.add_message("user", data.user_input)
 
     # Process intent and response
     try:
-        intent = askGemini(context_prompt, geminiIntentChat).strip().lower()
+        if message_count:
+            with timer.span("pending_lookup"):
+                current_pending = await run_db(get_current_pending_chat, user_id, conversation_id)
+        else:
+            current_pending = {"symptoms": [], "age": None, "gender": None, "previous_conditions": []}
+        await stage("intent")
+        merged = None
+        with timer.span("intent"):
+            pending = any(current_pending.values())
+            intent, confidence = intent_classifier.classify(data.user_input, config.symptom_index, pending)
+            if intent is not None:
+                intent_classifier.count(f"local_{intent}")
+                logger.info(f"Local intent '{intent}' ({confidence:.2f})")
+            else:
+                intent_classifier.count("llm")
+                if geminiMergedChat is not None:
+                    merged = parseMergedResponse(await askGeminiAsync(context("extraction"), geminiMergedChat))
+                    if merged is None:
+                        logger.warning("Merged intent/extraction reply failed validation; using separate calls")
+                        pipeline_metrics.count("merged_fallbacks_total")
+                    else:
+                        intent = merged["intent"]
+                        await run_db(record_intent_label, data.user_input, intent)
+                if merged is None:
+                    raw_intent = await askGeminiAsync(context("intent"), geminiIntentChat)
+                    intent = raw_intent.strip().lower()
+                    if raw_intent != GEMINI_ERROR_RESPONSE:
+                        await run_db(record_intent_label, data.user_input, "general" if intent == "general" else "symptom")
         if intent == "general":
-            finalResponse = askGemini(context_prompt, geminiConversationalChat)
+            await stage("conversational_response")
+            with timer.span("conversational_response"):
+                finalResponse = await reply(context("conversational"), geminiConversationalChat)
         else:
-            raw_response = askGemini(context_prompt, geminiDiseaseChat)
+            await stage("extraction")
+            if merged is not None:
+                raw_response = json.dumps(merged)
+            else:
+                with timer.span("extraction"):
+                    raw_response = await askGeminiAsync(context("extraction"), geminiDiseaseChat)
             try:
                 parsed_data = json.loads(raw_response)
                 new_symptoms = parsed_data.get("symptoms", [])
@@ -538,7 +2347,6 @@ async def predict(data: InputData, current_user: dict = Depends(get_current_user
                 new_gender = None
                 new_previous_conditions = []
 
-            current_pending = get_current_pending_chat(user_id, conversation_id)
             symptoms = list(set(current_pending["symptoms"] + new_symptoms)) if new_symptoms else current_pending["symptoms"]
             age = new_age if new_age is not None else current_pending["age"]
             gender = new_gender if new_gender is not None else current_pending["gender"]
@@ -561,37 +2369,66 @@ async def predict(data: InputData, current_user: dict = Depends(get_current_user
                 missing.append("previous health conditions")
 
             if missing:
+                writes.save_pending(symptoms, age, gender, previous_conditions)
                 finalResponse = f"Please provide your {', '.join(missing)}."
             else:
-                binary_vector = convertUserResponseToDatasetStructure(symptoms, symptom_master_list)
-                if sum(binary_vector) == 0:
+                with timer.span("prediction"):
+                    binary_vector = convertUserResponseToDatasetStructure(symptoms, config.symptom_index)
+                    differential = predict_disease_top_k(binary_vector) if sum(binary_vector) else []
+                if not differential:
                     finalResponse = "I couldn’t match those symptoms. Please describe them differently."
                 else:
-                    diseasesPredicted = predict_disease(binary_vector)
-                    adjustment_prompt = f"Disease: {diseasesPredicted}, Symptoms: {', '.join(symptoms)}, Age: {age}, Gender: {gender}, Previous Conditions: {', '.join(previous_conditions)}"
-                    raw_adjust_response = askGemini(adjustment_prompt, geminiAdjustmentChat)
-                    try:
-                        adjustments = json.loads(raw_adjust_response)
-                    except json.JSONDecodeError:
-                        adjustments = {"disease_adjustment": "None", "medicine_adjustment": "None"}
-                    ayurvedicRog = classifyDisease(diseasesPredicted, symptoms, geminiAryuvedicChat).strip()
-                    listOfAyurvedicMedication = getKeyValuesfromMedicineJson(aryuvedicMedicineData, ayurvedicRog)
-                    if not isinstance(listOfAyurvedicMedication, list):
-                        listOfAyurvedicMedication = listCleaner(listOfAyurvedicMedication)
-
-                    userMedicalData = (
-                        f"Disease Name: {diseasesPredicted}\n"
-                        f"Symptoms: {', '.join(symptoms)}\n"
-                        f"Age: {age}\n"
-                        f"Gender: {gender}\n"
-                        f"Previous Health Conditions: {', '.join(previous_conditions)}\n"
-                        f"Disease Adjustment: {adjustments.get('disease_adjustment', 'None')}\n"
-                        f"Medicine Adjustment: {adjustments.get('medicine_adjustment', 'None')}\n"
-                        f"Aurvedic Disease Name: {ayurvedicRog}\n"
-                        f"Aurvedic Medications List: {listOfAyurvedicMedication}"
-                    )
-                    finalResponse = askGemini(userMedicalData, geminiFinalResponseChat)
-                    delete_pending_chat(user_id, conversation_id)
+                    diseasesPredicted = differential[0][0]
+                    await stage("prediction", disease=diseasesPredicted, differential=differential)
+                    ranked = ", ".join(f"{disease} ({probability:.2f})" for disease, probability in differential)
+                    adjustment_prompt = f"Disease: {diseasesPredicted}, Differential: {ranked}, Symptoms: {', '.join(sorted(symptoms))}, Age: {age}, Gender: {gender}, Previous Conditions: {', '.join(sorted(previous_conditions))}"
+                    default_adjustments = {"disease_adjustment": "None", "medicine_adjustment": "None"}
+
+                    async def adjust():
+                        with timer.span("adjustment"):
+                            raw_adjust_response = await askGeminiCached(adjustment_prompt, geminiAdjustmentChat, config.adjustment_prompt, validate=json.loads)
+                        try:
+                            return json.loads(raw_adjust_response)
+                        except json.JSONDecodeError:
+                            return default_adjustments
+
+                    async def classify():
+                        with timer.span("ayurvedic_classification"):
+                            return (await classifyDisease(diseasesPredicted, symptoms, geminiAryuvedicChat, config.ayurvedic_system_prompt)).strip()
+
+                    async def respond(adjustments, ayurvedicRog):
+                        listOfAyurvedicMedication = getKeyValuesfromMedicineJson(config.ayurvedic_medicine_data, ayurvedicRog)
+                        if not isinstance(listOfAyurvedicMedication, list):
+                            listOfAyurvedicMedication = listCleaner(listOfAyurvedicMedication)
+
+                        userMedicalData = (
+                            f"Disease Name: {diseasesPredicted}\n"
+                            f"Symptoms: {', '.join(symptoms)}\n"
+                            f"Age: {age}\n"
+                            f"Gender: {gender}\n"
+                            f"Previous Health Conditions: {', '.join(previous_conditions)}\n"
+                            f"Disease Adjustment: {adjustments.get('disease_adjustment', 'None')}\n"
+                            f"Medicine Adjustment: {adjustments.get('medicine_adjustment', 'None')}\n"
+                            f"Aurvedic Disease Name: {ayurvedicRog}\n"
+                            f"Aurvedic Medications List: {listOfAyurvedicMedication}"
+                        )
+                        await stage("final_response")
+                        with timer.span("final_response"):
+                            return await reply(userMedicalData, geminiFinalResponseChat)
+
+                    # Adjustment and Ayurvedic classification only need the prediction,
+                    # so they run side by side; the final response waits for both.
+                    await stage("adjustment_and_classification")
+                    results = await runStageGraph({
+                        "adjustments": Stage(adjust, fallback=default_adjustments),
+                        "ayurvedicRog": Stage(classify, fallback=""),
+                        "final_response": Stage(respond, deps=("adjustments", "ayurvedicRog"), timeout=FINAL_RESPONSE_TIMEOUT)
+                    })
+                    finalResponse = results["final_response"]
+                    if finalResponse is None:
+                        finalResponse = "Sorry, something went wrong. Please try again."
+                    else:
+                        writes.delete_pending()
 
     except Exception as e:
         logger.error(f"Error processing AI response: {str(e)}")
@@ -599,126 +2436,548 @@ async def predict(data: InputData, current_user: dict = Depends(get_current_user
         conversation_id = conversation_id  # Ensure conversation_id is returned
 
     # Save bot response
-    try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO chats (user_id, conversation_id, sender, message) VALUES (?, ?, ?, ?)",
-            (user_id, conversation_id, "bot", finalResponse)
-        )
-        conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Database error saving bot message: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to save bot message")
-    finally:
-        conn.close()
+    writes.add_message("bot", finalResponse)
+    with timer.span("db_write"):
+        await run_db(writes.commit)
+    chat_sessions.set_version(user_id, conversation_id, message_count + writes.messages)
 
     return {"response": finalResponse, "conversation_id": conversation_id}
 
+@app.post("/predict")
+async def predict(data: InputData, response: Response, current_user: dict = Depends(get_current_user)):
+    timer = TurnTimer()
+    result = await processTurn(data, current_user, timer=timer)
+    if METRICS_TIMING_HEADER:
+        response.headers["Server-Timing"] = timer.server_timing()
+    return result
+
+# Streaming predict endpoint (server-sent events)
+# Emits "stage" events as the pipeline advances, "token" events with chunks of
+# the reply, then "done" with the same body /predict returns (or "error").
+# The turn runs as its own task, so the bot message is still saved if the client
+# disconnects mid-stream.
+_background_turns = set()
+
+@app.post("/predict_stream")
+async def predict_stream(data: InputData, current_user: dict = Depends(get_current_user)):
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def notify(event: str, payload: dict):
+        await events.put((event, payload))
+
+    async def run_turn():
+        try:
+            result = await processTurn(data, current_user, notify)
+            await events.put(("error" if "error" in result else "done", result))
+        except HTTPException as e:
+            await events.put(("error", {"detail": e.detail}))
+        except Exception as e:
+            logger.error(f"Error in streaming predict: {str(e)}")
+            await events.put(("error", {"detail": "Internal error"}))
+        finally:
+            await events.put(None)
+
+    task = asyncio.create_task(run_turn())
+    _background_turns.add(task)
+    task.add_done_callback(_background_turns.discard)
+
+    async def stream():
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            event, payload = item
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Batch prediction endpoint
+@app.post("/predict_batch")
+def predict_batch(data: BatchInputData, current_user: dict = Depends(get_current_user)):
+    if len(data.records) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batch too large (max {MAX_BATCH_SIZE} records)")
+    if data.model_name and not model_registry.has(data.model_name):
+        raise HTTPException(status_code=404, detail=f"Unknown model version '{data.model_name}'")
+    try:
+        config = get_config()
+        rankings, matched = predict_diseases_batch_top_k(data.records, config.symptom_index, PREDICTION_TOP_K, data.model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "predictions": [
+            {
+                "index": i,
+                "prediction": ranked[0][0] if ranked else "No disease predicted (no symptoms matched)",
+                "matched_symptoms": count,
+                "top_k": [{"disease": disease, "probability": probability} for disease, probability in ranked]
+            }
+            for i, (ranked, count) in enumerate(zip(rankings, matched))
+        ]
+    }
+
 # Updated chats endpoint
-@app.get("/chats")
-async def get_chat_history(
-    current_user: dict = Depends(get_current_user),
-    conversation_id: Optional[str] = None
-):
+# Keyset pagination in (timestamp, id) order. Without a cursor the latest page
+# is returned; "before" pages towards older messages and "after" towards newer
+# ones. Each page is returned oldest-first, and page.has_more says whether more
+# rows exist in the direction being paged. A request for one conversation with
+# no limit gets the whole conversation, which is what the chat UI loads.
+CHATS_PAGE_SIZE = int(os.getenv("CHATS_PAGE_SIZE", "100"))
+CHATS_MAX_PAGE_SIZE = int(os.getenv("CHATS_MAX_PAGE_SIZE", "500"))
+CHATS_EXPORT_BATCH = 500
+
+def _encodeCursor(timestamp: str, chat_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp}|{chat_id}".encode("utf-8")).decode("ascii")
+
+def _decodeCursor(cursor: str) -> Tuple[str, int]:
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        query = "SELECT sender, message, timestamp, conversation_id FROM chats WHERE user_id = ?"
-        params = [current_user["id"]]
-        if conversation_id:
-            query += " AND conversation_id = ?"
-            params.append(conversation_id)
-        query += " ORDER BY timestamp ASC"
-        cursor.execute(query, params)
-        chats = cursor.fetchall()
+        timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").rsplit("|", 1)
+        return timestamp, int(chat_id)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _fetch_chat_page(cursor, user_id: str, conversation_id: Optional[str], limit: Optional[int], before: Optional[str] = None, after: Optional[str] = None):
+    query = "SELECT id, sender, message, timestamp, conversation_id FROM chats WHERE user_id = ?"
+    params: list = [user_id]
+    if conversation_id:
+        query += " AND conversation_id = ?"
+        params.append(conversation_id)
+    if after:
+        query += " AND (timestamp, id) > (?, ?)"
+        params.extend(_decodeCursor(after))
+        direction = "ASC"
+    else:
+        if before:
+            query += " AND (timestamp, id) < (?, ?)"
+            params.extend(_decodeCursor(before))
+        direction = "DESC"
+    query += f" ORDER BY timestamp {direction}, id {direction}"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit + 1)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    has_more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    if direction == "DESC":
+        rows.reverse()
+    return rows, has_more
+
+def load_chat_history(user_id: str, conversation_id: Optional[str], limit: Optional[int] = CHATS_PAGE_SIZE, before: Optional[str] = None, after: Optional[str] = None):
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            chats, has_more = _fetch_chat_page(cursor, user_id, conversation_id, limit, before, after)
+            # Include conversation name if specific conversation_id is requested
+            conversation_name = None
+            archived = _fetch_archived_page(cursor, user_id, conversation_id, limit, before, after) if conversation_id else None
+            if archived is not None:
+                chats, has_more, conversation_name = archived
+            elif conversation_id:
+                conversation_name = _conversation_name(cursor, conversation_id, user_id)
         response = [
             {
-                "sender": chat[0],
-                "message": chat[1],
-                "timestamp": chat[2],
-                "conversation_id": chat[3]
+                "sender": chat[1],
+                "message": chat[2],
+                "timestamp": chat[3],
+                "conversation_id": chat[4]
             }
             for chat in chats
         ]
-        # Include conversation name if specific conversation_id is requested
-        conversation_name = None
-        if conversation_id:
-            conversation_name = generate_conversation_name(conversation_id, current_user["id"])
         return {
             "chats": response,
-            "conversation_name": conversation_name if conversation_id else None
+            "conversation_name": conversation_name if conversation_id else None,
+            "page": {
+                "before": _encodeCursor(chats[0][3], chats[0][0]) if chats else None,
+                "after": _encodeCursor(chats[-1][3], chats[-1][0]) if chats else None,
+                "has_more": has_more
+            }
         }
     except sqlite3.Error as e:
         logger.error(f"Database error in get_chat_history: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to retrieve chat history")
-    finally:
-        conn.close()
 
-# Updated search endpoint
-@app.get("/search_chats")
-async def search_chat_history(
+@app.get("/chats")
+async def get_chat_history(
+    current_user: dict = Depends(get_current_user),
+    conversation_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=CHATS_MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    if limit is None and not conversation_id:
+        limit = CHATS_PAGE_SIZE
+    return await run_db(load_chat_history, current_user["id"], conversation_id, limit, before, after)
+
+# Full history export, encoded and sent in keyset batches so neither the rows
+# nor the JSON body are ever held in memory at once. A pooled connection is only
+# held while a batch is being read.
+def export_chats(user_id: str, conversation_id: Optional[str]):
+    yield b'{"chats": ['
+    after = None
+    first = True
+    while True:
+        try:
+            with db_pool.connection() as conn:
+                rows, has_more = _fetch_chat_page(conn.cursor(), user_id, conversation_id, CHATS_EXPORT_BATCH, after=after)
+        except sqlite3.Error as e:
+            # Abort the stream so the client gets a truncated body, never a
+            # well-formed document with part of the history missing
+            logger.error(f"Database error in export_chats: {str(e)}")
+            raise
+        for row in rows:
+            chat = {"sender": row[1], "message": row[2], "timestamp": row[3], "conversation_id": row[4]}
+            yield (b"" if first else b",") + json.dumps(chat).encode("utf-8")
+            first = False
+        if not has_more:
+            break
+        after = _encodeCursor(rows[-1][3], rows[-1][0])
+    yield b"]}"
+
+@app.get("/chats/export")
+def export_chat_history(
     current_user: dict = Depends(get_current_user),
-    keyword: str = Query(..., description="Keyword to search in messages"),
     conversation_id: Optional[str] = None
 ):
+    return StreamingResponse(export_chats(current_user["id"], conversation_id), media_type="application/json")
+
+# Updated search endpoint
+# Every word of the keyword must match, each as a prefix ("fev" finds "fever"),
+# and only inside the caller's own rows (the owner token). Results are ordered
+# by bm25 relevance over the message column and carry a highlighted snippet.
+SEARCH_MAX_LIMIT = 200
+
+def _ftsQuery(keyword: str, user_id) -> str:
+    terms = re.findall(r"\w+", keyword)
+    if not terms:
+        return ""
+    return f'owner : "{_ftsOwner(user_id)}" AND message : (' + " ".join(f'"{term}"*' for term in terms) + ")"
+
+def search_chats(user_id: str, keyword: str, conversation_id: Optional[str], limit: int = 50, offset: int = 0):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        query = """
-            SELECT sender, message, timestamp, conversation_id
-            FROM chats
-            WHERE user_id = ? AND message LIKE ?
-        """
-        params = [current_user["id"], f"%{keyword}%"]
-        if conversation_id:
-            query += " AND conversation_id = ?"
-            params.append(conversation_id)
-        query += " ORDER BY timestamp ASC"
-        cursor.execute(query, params)
-        chats = cursor.fetchall()
-        return [
-            {
-                "sender": chat[0],
-                "message": chat[1],
-                "timestamp": chat[2],
-                "conversation_id": chat[3]
-            }
-            for chat in chats
-        ]
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            if chat_search_enabled:
+                match = _ftsQuery(keyword, user_id)
+                if not match:
+                    return []
+                query = """
+                    SELECT c.sender, c.message, c.timestamp, c.conversation_id,
+                           snippet(chats_fts, 0, '<mark>', '</mark>', '...', 12), bm25(chats_fts, 1.0, 0.0)
+                    FROM chats_fts
+                    JOIN chats c ON c.id = chats_fts.rowid
+                    WHERE chats_fts MATCH ? AND c.user_id = ?
+                """
+                params = [match, user_id]
+                order = " ORDER BY bm25(chats_fts, 1.0, 0.0), c.timestamp DESC"
+            else:
+                query = """
+                    SELECT sender, message, timestamp, conversation_id, message, NULL
+                    FROM chats c
+                    WHERE user_id = ? AND message LIKE ?
+                """
+                params = [user_id, f"%{keyword}%"]
+                order = " ORDER BY timestamp ASC"
+            if conversation_id:
+                query += " AND c.conversation_id = ?"
+                params.append(conversation_id)
+            query += order + " LIMIT ? OFFSET ?"
+            params.extend([limit, offset])
+            cursor.execute(query, params)
+            chats = cursor.fetchall()
+            return [
+                {
+                    "sender": chat[0],
+                    "message": chat[1],
+                    "timestamp": chat[2],
+                    "conversation_id": chat[3],
+                    "snippet": chat[4],
+                    "rank": chat[5]
+                }
+                for chat in chats
+            ]
     except sqlite3.Error as e:
         logger.error(f"Database error in search_chat_history: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to search chat history")
-    finally:
-        conn.close()
+
+@app.get("/search_chats")
+async def search_chat_history(
+    current_user: dict = Depends(get_current_user),
+    keyword: str = Query(..., description="Keyword to search in messages"),
+    conversation_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=SEARCH_MAX_LIMIT),
+    offset: int = Query(0, ge=0)
+):
+    return await run_db(search_chats, current_user["id"], keyword, conversation_id, limit, offset)
 
 # New conversations endpoint
-@app.get("/conversations")
-async def get_conversations(current_user: dict = Depends(get_current_user)):
+def load_conversations(user_id: str):
     try:
-        conn = sqlite3.connect("ayurvaid.db")
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT conversation_id, MAX(timestamp) as latest_timestamp
-            FROM chats
-            WHERE user_id = ?
-            GROUP BY conversation_id
-            ORDER BY latest_timestamp DESC
-            """,
-            (current_user["id"],)
-        )
-        conversations = cursor.fetchall()
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT conversation_id, latest_timestamp, name, message_count
+                FROM conversations
+                WHERE user_id = ?
+                ORDER BY latest_timestamp DESC
+                """,
+                (user_id,)
+            )
+            conversations = cursor.fetchall()
         return [
             {
                 "conversation_id": conv[0],
                 "latest_timestamp": conv[1],
-                "name": generate_conversation_name(conv[0], current_user["id"])
+                "name": conv[2] or generate_conversation_name(conv[0], user_id),
+                "message_count": conv[3]
             }
             for conv in conversations
         ]
     except sqlite3.Error as e:
         logger.error(f"Database error in get_conversations: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to retrieve conversations")
-    finally:
-        conn.close()
+
+@app.get("/conversations")
+async def get_conversations(current_user: dict = Depends(get_current_user)):
+    return await run_db(load_conversations, current_user["id"])
+
+# Model status endpoint
+@app.get("/models")
+def get_models(current_user: dict = Depends(get_current_user)):
+    return model_registry.status()
+
+# Retention and compaction
+# A daemon thread keeps the hot tables small: it expires pending_chats rows
+# older than PENDING_CHAT_TTL_HOURS and expired llm_cache rows, trims
+# intent_labels to the INTENT_TRAINING_LIMIT newest, and it moves
+# conversations idle for ARCHIVE_AFTER_DAYS into archived_conversations as one
+# compressed row each. The chats_fts delete trigger keeps search in step. It
+# then runs incremental vacuum, PRAGMA optimize (which runs ANALYZE where
+# statistics are stale), an FTS merge and a WAL checkpoint. /chats still reads
+# archived conversations, and a new turn in one restores it first. Each run
+# first takes the maintenance_lease row under BEGIN IMMEDIATE, so with several
+# worker processes only one of them does the work.
+def _archived_rows(cursor, user_id: str, conversation_id: str):
+    cursor.execute(
+        "SELECT name, payload FROM archived_conversations WHERE user_id = ? AND conversation_id = ?",
+        (user_id, conversation_id)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    messages = json.loads(zlib.decompress(row[1]))
+    return row[0], [(m["id"], m["sender"], m["message"], m["timestamp"], conversation_id) for m in messages]
+
+def _fetch_archived_page(cursor, user_id: str, conversation_id: str, limit: Optional[int], before: Optional[str] = None, after: Optional[str] = None):
+    archived = _archived_rows(cursor, user_id, conversation_id)
+    if archived is None:
+        return None
+    name, rows = archived
+    # Messages written after the archive was taken are still in chats
+    cursor.execute(
+        "SELECT id, sender, message, timestamp, conversation_id FROM chats WHERE user_id = ? AND conversation_id = ?",
+        (user_id, conversation_id)
+    )
+    rows = sorted(rows + cursor.fetchall(), key=lambda row: (row[3], row[0]))
+    if limit is None:
+        limit = len(rows)
+    if after:
+        position = _decodeCursor(after)
+        rows = [row for row in rows if (row[3], row[0]) > position]
+        return rows[:limit], len(rows) > limit, name
+    if before:
+        position = _decodeCursor(before)
+        rows = [row for row in rows if (row[3], row[0]) < position]
+    return rows[-limit:], len(rows) > limit, name
+
+def archive_conversation(cursor, user_id: str, conversation_id: str, name: Optional[str]):
+    cursor.execute(
+        "SELECT id, sender, message, timestamp FROM chats WHERE user_id = ? AND conversation_id = ? ORDER BY timestamp, id",
+        (user_id, conversation_id)
+    )
+    messages = [{"id": r[0], "sender": r[1], "message": r[2], "timestamp": r[3]} for r in cursor.fetchall()]
+    # Merge with an earlier archive of the same conversation instead of replacing it
+    archived = _archived_rows(cursor, user_id, conversation_id)
+    if archived is not None:
+        name = archived[0] or name
+        earlier = [{"id": r[0], "sender": r[1], "message": r[2], "timestamp": r[3]} for r in archived[1]]
+        messages = sorted(earlier + messages, key=lambda m: (m["timestamp"], m["id"]))
+    if messages:
+        cursor.execute(
+            "INSERT OR REPLACE INTO archived_conversations (user_id, conversation_id, name, latest_timestamp, message_count, payload) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, conversation_id, name, messages[-1]["timestamp"], len(messages), zlib.compress(json.dumps(messages).encode("utf-8"), 9))
+        )
+    for table in ("chats", "pending_chats", "conversation_summaries", "conversations"):
+        cursor.execute(f"DELETE FROM {table} WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+
+def restore_archived_conversation(user_id: str, conversation_id: str) -> int:
+    try:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            archived = _archived_rows(cursor, user_id, conversation_id)
+            if archived is None:
+                return 0
+            cursor.executemany(
+                "INSERT OR IGNORE INTO chats (user_id, conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, conversation_id, sender, message, timestamp) for _, sender, message, timestamp, _ in archived[1]]
+            )
+            cursor.execute("DELETE FROM archived_conversations WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+            conn.commit()
+            logger.info(f"Restored archived conversation {conversation_id} for user_id: {user_id}")
+            return len(archived[1])
+    except sqlite3.Error as e:
+        logger.error(f"Database error restoring archived conversation: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to restore conversation")
+
+class MaintenanceWorker:
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._stats = {"runs": 0, "failures": 0, "skipped": 0, "pending_expired": 0, "llm_cache_expired": 0, "intent_labels_pruned": 0, "conversations_archived": 0, "last_run_seconds": 0.0, "last_run_at": None}
+
+    def start(self):
+        if self._interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self._interval):
+            self.run_once()
+
+    def _count(self, counter: str, value: int):
+        with self._lock:
+            self._stats[counter] += value
+
+    def _acquire_lease(self, conn) -> bool:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at FROM maintenance_lease WHERE name = 'maintenance'").fetchone()
+            if row is not None and row[0] != self._owner and row[1] > now:
+                conn.rollback()
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO maintenance_lease (name, owner, expires_at) VALUES ('maintenance', ?, ?)",
+                (self._owner, now + 2 * max(self._interval, 60))
+            )
+            conn.commit()
+            return True
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def _expire(self, cursor):
+        cutoff = (datetime.utcnow() - timedelta(hours=PENDING_CHAT_TTL_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute("DELETE FROM pending_chats WHERE created_at < ?", (cutoff,))
+        self._count("pending_expired", cursor.rowcount)
+        cursor.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - LLM_CACHE_TTL,))
+        self._count("llm_cache_expired", cursor.rowcount)
+        # Training only reads the newest INTENT_TRAINING_LIMIT labels; older
+        # ones are just stored user messages
+        cursor.execute(
+            "DELETE FROM intent_labels WHERE id <= (SELECT id FROM intent_labels ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (INTENT_TRAINING_LIMIT,)
+        )
+        self._count("intent_labels_pruned", cursor.rowcount)
+
+    def _archive(self, conn) -> List[Tuple[str, str]]:
+        if ARCHIVE_AFTER_DAYS <= 0:
+            return []
+        cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id, conversation_id, name FROM conversations WHERE latest_timestamp < ? LIMIT ?",
+            (cutoff, ARCHIVE_BATCH_SIZE)
+        )
+        archived = []
+        for user_id, conversation_id, name in cursor.fetchall():
+            archive_conversation(cursor, user_id, conversation_id, name)
+            conn.commit()
+            archived.append((user_id, conversation_id))
+        self._count("conversations_archived", len(archived))
+        return archived
+
+    def _compact(self, conn):
+        incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if not incremental and MAINTENANCE_CONVERT_AUTO_VACUUM:
+            # One-off conversion; incremental vacuum only works once the file has been rebuilt
+            logger.info("Switching database to incremental auto_vacuum (one-time VACUUM)")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            incremental = True
+        if incremental:
+            # executescript steps the pragma to completion; execute() frees one page
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        if chat_search_enabled:
+            conn.execute("INSERT INTO chats_fts (chats_fts, rank) VALUES ('merge', 500)")
+            conn.commit()
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def run_once(self):
+        started = time.monotonic()
+        try:
+            with db_pool.connection() as conn:
+                if not self._acquire_lease(conn):
+                    self._count("skipped", 1)
+                    return
+                self._expire(conn.cursor())
+                conn.commit()
+                archived = self._archive(conn)
+                self._compact(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Database error in maintenance: {str(e)}")
+            self._count("failures", 1)
+            return
+        for user_id, conversation_id in archived:
+            chat_sessions.discard(user_id, conversation_id)
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["last_run_seconds"] = round(time.monotonic() - started, 3)
+            self._stats["last_run_at"] = datetime.now().isoformat()
+        logger.info(f"Maintenance finished in {self._stats['last_run_seconds']}s, archived {len(archived)} conversations")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+maintenance = MaintenanceWorker(MAINTENANCE_INTERVAL)
+
+@app.on_event("startup")
+def start_maintenance():
+    maintenance.start()
+
+@app.on_event("shutdown")
+def stop_maintenance():
+    maintenance.stop()
+
+@app.get("/conversations/archived")
+def get_archived_conversations(current_user: dict = Depends(get_current_user)):
+    try:
+        with db_pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT conversation_id, latest_timestamp, name, message_count FROM archived_conversations WHERE user_id = ? ORDER BY latest_timestamp DESC",
+                (current_user["id"],)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error in get_archived_conversations: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to retrieve archived conversations")
+    return [{"conversation_id": r[0], "latest_timestamp": r[1], "name": r[2], "message_count": r[3]} for r in rows]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    gauges = {"db_pool": db_pool.stats(), "llm_cache": llm_cache.stats(), "sessions": chat_sessions.stats(), "intent": intent_classifier.stats(), "user_cache": user_cache.stats(), "maintenance": maintenance.stats()}
+    return PlainTextResponse(pipeline_metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+# Runtime statistics endpoint
+@app.get("/stats")
+def get_stats(current_user: dict = Depends(get_current_user)):
+    return {"db_pool": db_pool.stats(), "llm_cache": llm_cache.stats(), "sessions": chat_sessions.stats(), "intent": intent_classifier.stats(), "user_cache": user_cache.stats(), "maintenance": maintenance.stats()}
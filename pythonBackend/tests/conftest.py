@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main opens its database and LLM client at import time, so point both at
+# throwaway settings before any test module imports it
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "test.db"))
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("MAINTENANCE_INTERVAL", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
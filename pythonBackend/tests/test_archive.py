@@ -0,0 +1,65 @@
+import main
+
+MESSAGES = [
+    ("user", "I have fever and cough", "2020-01-01 10:00:00.000"),
+    ("bot", "Please provide your age, gender, previous health conditions.", "2020-01-01 10:00:01.000"),
+    ("user", "34, female, none", "2020-01-01 10:00:02.000"),
+]
+
+def _chats(user_id, conversation_id):
+    with main.db_pool.connection() as conn:
+        return conn.execute(
+            "SELECT sender, message, timestamp FROM chats WHERE user_id = ? AND conversation_id = ? ORDER BY timestamp, id",
+            (user_id, conversation_id)
+        ).fetchall()
+
+def test_archive_restore_round_trip():
+    user_id, conversation_id = 4242, "archive-round-trip"
+    with main.db_pool.connection() as conn:
+        conn.executemany(
+            "INSERT INTO chats (user_id, conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, conversation_id, sender, message, timestamp) for sender, message, timestamp in MESSAGES]
+        )
+        conn.commit()
+        main.archive_conversation(conn.cursor(), user_id, conversation_id, "fever")
+        conn.commit()
+        assert conn.execute("SELECT COUNT(*) FROM conversations WHERE conversation_id = ?", (conversation_id,)).fetchone()[0] == 0
+
+    assert _chats(user_id, conversation_id) == []
+    history = main.load_chat_history(user_id, conversation_id, limit=10)
+    assert history["conversation_name"] == "fever"
+    assert [(c["sender"], c["message"], c["timestamp"]) for c in history["chats"]] == MESSAGES
+
+    assert main.restore_archived_conversation(user_id, conversation_id) == len(MESSAGES)
+    assert _chats(user_id, conversation_id) == MESSAGES
+    with main.db_pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM archived_conversations WHERE conversation_id = ?", (conversation_id,)).fetchone()[0] == 0
+    assert main.restore_archived_conversation(user_id, conversation_id) == 0
+
+def test_turn_committed_after_archive_keeps_history():
+    user_id, conversation_id = 4343, "archive-race"
+    late = ("user", "still coughing", "2020-01-02 09:00:00.000")
+    with main.db_pool.connection() as conn:
+        conn.executemany(
+            "INSERT INTO chats (user_id, conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, conversation_id, sender, message, timestamp) for sender, message, timestamp in MESSAGES]
+        )
+        conn.commit()
+        main.archive_conversation(conn.cursor(), user_id, conversation_id, "fever")
+        conn.commit()
+        # A turn that read the message count before the archive commits afterwards
+        conn.execute(
+            "INSERT INTO chats (user_id, conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (user_id, conversation_id) + late
+        )
+        conn.commit()
+
+    history = main.load_chat_history(user_id, conversation_id, limit=None)
+    assert [(c["sender"], c["message"], c["timestamp"]) for c in history["chats"]] == MESSAGES + [late]
+
+    # The next archive run merges with the earlier payload instead of replacing it
+    with main.db_pool.connection() as conn:
+        main.archive_conversation(conn.cursor(), user_id, conversation_id, "still coughing")
+        conn.commit()
+    assert main.restore_archived_conversation(user_id, conversation_id) == len(MESSAGES) + 1
+    assert _chats(user_id, conversation_id) == MESSAGES + [late]
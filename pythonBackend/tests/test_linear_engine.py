@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LogisticRegression
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.preprocessing import LabelEncoder
+
+from main import LinearEngine
+
+DISEASES = ["Flu", "Migraine", "Dermatitis", "Gastroenteritis", "Heart Disease"]
+
+@pytest.fixture(scope="module")
+def bundle():
+    rng = np.random.default_rng(7)
+    columns = [f"symptom_{i}" for i in range(20)]
+    X = pd.DataFrame(rng.integers(0, 2, size=(400, len(columns))), columns=columns)
+    y = [DISEASES[i] for i in rng.integers(0, len(DISEASES), size=len(X))]
+    label_encoder = LabelEncoder().fit(y)
+    model = OneVsRestClassifier(LogisticRegression(max_iter=1000)).fit(X, label_encoder.transform(y))
+    samples = pd.DataFrame(rng.integers(0, 2, size=(50, len(columns))), columns=columns)
+    return {"model": model, "label_encoder": label_encoder}, samples
+
+def test_matches_sklearn(bundle):
+    bundle, samples = bundle
+    engine = LinearEngine.from_bundle(bundle)
+    assert engine is not None
+    model, label_encoder = bundle["model"], bundle["label_encoder"]
+    expected_labels = label_encoder.inverse_transform(model.predict(samples))
+    expected_probabilities = model.predict_proba(samples)
+
+    assert list(engine.predict(samples.to_numpy())) == list(expected_labels)
+    np.testing.assert_allclose(engine.probabilities(samples.to_numpy()), expected_probabilities, rtol=1e-9, atol=1e-12)
+
+    classes = label_encoder.inverse_transform(model.classes_)
+    for row, vector in enumerate(samples.to_numpy()):
+        assert engine.predict(vector) == expected_labels[row]
+        top = np.argsort(-expected_probabilities[row])[:3]
+        assert engine.top_k(vector, 3) == [(str(classes[i]), round(float(expected_probabilities[row, i]), 4)) for i in top]
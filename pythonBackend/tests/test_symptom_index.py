@@ -0,0 +1,36 @@
+import pytest
+
+from main import SymptomIndex
+
+MASTER = [
+    "increased_appetite", "decreased_appetite_loss", "high_fever", "mild_fever",
+    "headache", "chest_pain", "loss_of_appetite", "stomach_pain"
+]
+
+@pytest.fixture(scope="module")
+def index():
+    return SymptomIndex(MASTER, synonyms={"tummy ache": "stomach_pain"})
+
+@pytest.mark.parametrize("wording, expected", [
+    ("headache", "headache"),
+    ("Chest Pain", "chest_pain"),
+    ("pain in chest", "chest_pain"),
+    ("headaches", "headache"),
+    ("stomach pains", "stomach_pain"),
+    ("tummy ache", "stomach_pain"),
+    ("tummy ached", "stomach_pain"),
+])
+def test_matches(index, wording, expected):
+    assert index.lookup(wording) == MASTER.index(expected)
+
+@pytest.mark.parametrize("wording", [
+    "decreased appetite",
+    "reduced appetite",
+    "low fever",
+    "severe fever",
+    "high appetite",
+    "chest",
+    "back pain",
+])
+def test_near_misses_do_not_match(index, wording):
+    assert index.lookup(wording) is None